@@ -0,0 +1,401 @@
+"""Display Sync benchmark - simulated displays and controls against a local server.
+
+Starts server.py from a scratch copy (so benchmarks never touch your library
+or saved state), connects N displays and M controls over real WebSockets,
+runs a series of phases and reports throughput, end-to-end latency, scene
+flip spread and server CPU/memory. Results are saved as JSON so runs can be
+compared:
+
+    python bench.py --displays 100 --controls 2
+    python bench.py --displays 100 --compare bench_results/<earlier>.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from urllib.request import urlopen
+
+try:
+    import websockets
+except ImportError:
+    sys.exit("bench.py needs websockets: pip install websockets")
+
+BASE_DIR = Path(__file__).resolve().parent
+RESULTS_DIR = BASE_DIR / "bench_results"
+SCENES = ["gradient", "waves", "particles", "matrix"]
+# Markers the controls put in state so displays can time delivery
+MARK = "bench:"
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile (0 for empty input)."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))]
+
+
+def summarize(samples):
+    """p50/p95/p99/max in milliseconds."""
+    return {
+        "count": len(samples),
+        "p50Ms": round(percentile(samples, 50) * 1000, 2),
+        "p95Ms": round(percentile(samples, 95) * 1000, 2),
+        "p99Ms": round(percentile(samples, 99) * 1000, 2),
+        "maxMs": round(max(samples, default=0) * 1000, 2)
+    }
+
+
+def mark(field):
+    return f"{MARK}{field}:{time.time():.6f}"
+
+
+def read_mark(value):
+    """Send time encoded in a marker, or None."""
+    if isinstance(value, str) and value.startswith(MARK):
+        try:
+            return float(value.rsplit(":", 1)[1])
+        except ValueError:
+            return None
+    return None
+
+
+class ProcessSampler:
+    """CPU and memory of the server process, read from /proc (Linux only)."""
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.page = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.cpu = []
+        self.rss = []
+
+    def _read(self):
+        try:
+            fields = Path(f"/proc/{self.pid}/stat").read_text().rsplit(")", 1)[1].split()
+            pages = int(Path(f"/proc/{self.pid}/statm").read_text().split()[1])
+        except (OSError, IndexError, ValueError):
+            return None
+        return (int(fields[11]) + int(fields[12])) / self.tick, pages * self.page
+
+    async def run(self, interval=0.5):
+        last = self._read()
+        last_time = time.perf_counter()
+        while last:
+            await asyncio.sleep(interval)
+            sample = self._read()
+            if not sample:
+                return
+            now = time.perf_counter()
+            self.cpu.append((sample[0] - last[0]) / (now - last_time) * 100)
+            self.rss.append(sample[1])
+            last, last_time = sample, now
+
+    def to_dict(self):
+        if not self.cpu:
+            return {"available": False}
+        return {
+            "available": True,
+            "cpuAvgPct": round(sum(self.cpu) / len(self.cpu), 1),
+            "cpuPeakPct": round(max(self.cpu), 1),
+            "rssPeakMB": round(max(self.rss) / 1e6, 1)
+        }
+
+
+class SimDisplay:
+    """A display that speaks register_display / scene_ready with an artificial load delay."""
+    def __init__(self, url, display_id, load_delay, load_jitter, encodings=()):
+        self.url = url
+        self.encodings = list(encodings)
+        self.display_id = display_id
+        self.load_delay = load_delay
+        self.load_jitter = load_jitter
+        self.ws = None
+        self.ready = asyncio.Event()
+        self.received = 0
+        self.resyncs = 0
+        self.latencies = {}
+        self.shows = {}
+        self.version = 0
+
+    async def run(self):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        await self.ws.send(json.dumps({"type": "register_display", "displayId": self.display_id,
+                                       "encodings": self.encodings}))
+        async for raw in self.ws:
+            now = time.time()
+            self.received += 1
+            msg = json.loads(zlib.decompress(raw, -15) if isinstance(raw, bytes) else raw)
+            msg_type = msg.get("type")
+            if msg_type in ("init", "state_update"):
+                self.version = msg.get("version", 0)
+                self.ready.set()
+            elif msg_type == "state_patch":
+                if msg["version"] <= self.version:
+                    continue
+                if msg["version"] != self.version + 1:
+                    self.resyncs += 1
+                    await self.ws.send(json.dumps({"type": "request_state"}))
+                self.version = msg["version"]
+                for value in msg.get("changes", {}).values():
+                    if isinstance(value, dict):
+                        # canvasLayout carries its marker one level down
+                        value = value.get("bench")
+                    sent = read_mark(value)
+                    if sent:
+                        self.latencies.setdefault(value.split(":")[1], []).append(now - sent)
+                if msg.get("sceneId"):
+                    asyncio.create_task(self._load(msg["sceneId"]))
+            elif msg_type == "show_scene":
+                self.shows[msg["sceneId"]] = (now, msg.get("showAt", 0) / 1000)
+
+    async def _load(self, scene_id):
+        delay = max(0.0, random.gauss(self.load_delay, self.load_jitter))
+        await asyncio.sleep(delay)
+        await self.ws.send(json.dumps({"type": "scene_ready", "sceneId": scene_id}))
+
+
+class SimControl:
+    """A control panel driving updates."""
+    def __init__(self, url):
+        self.url = url
+        self.ws = None
+        self.sent = 0
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        await self.ws.send(json.dumps({"type": "register_control"}))
+        asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            async for _ in self.ws:
+                pass
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def send(self, message):
+        self.sent += 1
+        await self.ws.send(json.dumps(message))
+
+
+async def at_rate(rate, duration, step):
+    """Call step(i) rate times a second for duration seconds."""
+    interval = 1 / rate
+    start = time.perf_counter()
+    i = 0
+    while time.perf_counter() - start < duration:
+        await step(i)
+        i += 1
+        await asyncio.sleep(max(0, start + i * interval - time.perf_counter()))
+
+
+async def phase_sliders(controls, args):
+    """Slider storm: every control drags speed/intensity at the given rate."""
+    async def step(i):
+        control = controls[i % len(controls)]
+        await control.send({"type": "update_state", "state": {"speed": 0.5 + (i % 40) / 10, "text": mark("sliders")}})
+    await at_rate(args.rate * len(controls), args.duration, step)
+
+
+async def phase_canvas(controls, args):
+    """Canvas drag: an element moved across the wall at the given rate."""
+    async def step(i):
+        element = {"id": "bench", "type": "rect", "x": (i * 7) % 3000, "y": 100, "w": 400, "h": 300, "color": "#3b82f6"}
+        await controls[i % len(controls)].send({"type": "canvas_elements", "elements": [element],
+                                                "canvasLayout": {"bench": mark("canvas")}})
+    await at_rate(args.rate * len(controls), args.duration, step)
+
+
+async def phase_html(controls, args):
+    """Large broadcast_html payloads."""
+    body = "<div>" + "x" * (args.html_kb * 1024) + "</div>"
+    for i in range(args.html_count):
+        await controls[i % len(controls)].send({"type": "broadcast_html", "html": body, "name": mark("html")})
+        await asyncio.sleep(0.5)
+
+
+async def phase_scenes(controls, displays, args):
+    """Scene flips through the sync handshake; returns flip latency and spread."""
+    flips, spreads, late = [], [], 0
+    for i in range(args.flips):
+        before = {id(d): set(d.shows) for d in displays}
+        sent = time.time()
+        await controls[0].send({"type": "update_state", "state": {"scene": SCENES[i % len(SCENES)]}})
+        deadline = sent + 15
+        while time.time() < deadline:
+            await asyncio.sleep(0.05)
+            new = [set(d.shows) - before[id(d)] for d in displays]
+            if all(new):
+                break
+        received = []
+        for display, scene_ids in zip(displays, new):
+            for scene_id in scene_ids:
+                at, show_at = display.shows[scene_id]
+                received.append(at)
+                # Same machine, same clock: arriving after showAt means a late flip
+                late += at > show_at
+        if received:
+            flips.append(max(received) - sent)
+            spreads.append(max(received) - min(received))
+        await asyncio.sleep(0.3)
+    return {"flip": summarize(flips), "receiveSpread": summarize(spreads), "lateDisplays": late}
+
+
+def start_server(args, workdir):
+    """Copy the server into workdir and start it; returns the process."""
+    for name in ("server.py",):
+        shutil.copy(BASE_DIR / name, workdir / name)
+    for name in ("public", "scenes"):
+        shutil.copytree(BASE_DIR / name, workdir / name, ignore=shutil.ignore_patterns("custom"))
+    log = open(workdir / "server.log", "w")
+    return subprocess.Popen(
+        [sys.executable, "server.py", "--port", str(args.port), "--log-level", "warning"],
+        cwd=workdir, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+async def wait_for_server(url, timeout=15):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            ws = await websockets.connect(url)
+            await ws.close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run(args, server_pid):
+    url = f"ws://{args.host}:{args.port + 1}"
+    await wait_for_server(url)
+    sampler = ProcessSampler(server_pid) if server_pid else None
+    sampling = asyncio.create_task(sampler.run()) if sampler else None
+
+    encodings = ["deflate-json"] if args.deflate_json else []
+    displays = [SimDisplay(url, i + 1, args.load_delay, args.load_jitter, encodings) for i in range(args.displays)]
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(d.run()) for d in displays]
+    await asyncio.wait_for(asyncio.gather(*(d.ready.wait() for d in displays)), 120)
+    connect_time = time.perf_counter() - started
+
+    controls = [SimControl(url) for _ in range(args.controls)]
+    for control in controls:
+        await control.connect()
+
+    results = {"connectSeconds": round(connect_time, 2), "phases": {}}
+    phases = [("sliders", phase_sliders), ("canvas", phase_canvas), ("html", phase_html)]
+    for name, phase in phases:
+        if name not in args.phases:
+            continue
+        received = sum(d.received for d in displays)
+        sent = sum(c.sent for c in controls)
+        start = time.perf_counter()
+        await phase(controls, args)
+        await asyncio.sleep(1)
+        elapsed = time.perf_counter() - start
+        latencies = [s for d in displays for s in d.latencies.pop(name, [])]
+        results["phases"][name] = {
+            "sentPerSec": round((sum(c.sent for c in controls) - sent) / elapsed, 1),
+            "deliveredPerSec": round((sum(d.received for d in displays) - received) / elapsed, 1),
+            "latency": summarize(latencies)
+        }
+    if "scenes" in args.phases:
+        results["phases"]["scenes"] = await phase_scenes(controls, displays, args)
+
+    results["resyncs"] = sum(d.resyncs for d in displays)
+    try:
+        with urlopen(f"http://{args.host}:{args.port}/api/stats", timeout=5) as response:
+            transport = json.load(response).get("transport", {})
+        sent = [c for c in transport.get("clients", []) if c["client"].startswith("Display")]
+        results["transport"] = {
+            "binaryFrames": transport.get("binaryFrames"),
+            "textBytes": sum(c["textBytes"] for c in sent),
+            "sentBytes": sum(c["sentBytes"] for c in sent)
+        }
+    except (OSError, ValueError):
+        pass
+    if sampling:
+        sampling.cancel()
+        results["server"] = sampler.to_dict()
+    for task in tasks:
+        task.cancel()
+    return results
+
+
+def compare(current, previous):
+    """Print p99 latency and throughput changes against an earlier run."""
+    print(f"\nCompared with {previous['started']}:")
+    for name, phase in current["phases"].items():
+        old = previous.get("phases", {}).get(name)
+        if not old:
+            continue
+        for key in ("latency", "flip", "receiveSpread"):
+            if key in phase and key in old:
+                print(f"  {name:8} {key:14} p99 {old[key]['p99Ms']:>8} -> {phase[key]['p99Ms']:>8} ms")
+        if "deliveredPerSec" in phase:
+            print(f"  {name:8} {'delivered/s':14}     {old['deliveredPerSec']:>8} -> {phase['deliveredPerSec']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark display-sync with simulated clients")
+    parser.add_argument("--displays", type=int, default=50)
+    parser.add_argument("--controls", type=int, default=1)
+    parser.add_argument("--phases", default="sliders,canvas,html,scenes",
+                        help="comma-separated subset of sliders,canvas,html,scenes")
+    parser.add_argument("--rate", type=float, default=60, help="updates per second per control")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per storm phase")
+    parser.add_argument("--html-kb", type=int, default=256)
+    parser.add_argument("--html-count", type=int, default=5)
+    parser.add_argument("--flips", type=int, default=10)
+    parser.add_argument("--load-delay", type=float, default=0.05, help="mean simulated scene load time (s)")
+    parser.add_argument("--load-jitter", type=float, default=0.02)
+    parser.add_argument("--deflate-json", action="store_true",
+                        help="displays negotiate binary deflated frames instead of JSON text")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3100, help="HTTP port; WebSockets use the next one")
+    parser.add_argument("--external", action="store_true",
+                        help="benchmark an already running server instead of starting one")
+    parser.add_argument("--pid", type=int, help="server PID for CPU/memory sampling with --external")
+    parser.add_argument("--save", default=str(RESULTS_DIR), help="directory for the results JSON")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+    args.phases = set(args.phases.split(","))
+
+    server = workdir = None
+    if not args.external:
+        workdir = Path(tempfile.mkdtemp(prefix="display-sync-bench-"))
+        server = start_server(args, workdir)
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    try:
+        results = asyncio.run(run(args, server.pid if server else args.pid))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {k: (sorted(v) if isinstance(v, set) else v) for k, v in vars(args).items() if k not in ("save", "compare")}
+    report = {"started": started, "config": config, **results}
+    print(json.dumps(report, indent=2))
+    out_dir = Path(args.save)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_file = out_dir / f"bench_{started.replace(':', '')}_{args.displays}d.json"
+    out_file.write_text(json.dumps(report, indent=2))
+    print(f"\nSaved {out_file}")
+    if args.compare:
+        compare(report, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -37,10 +37,17 @@ var state = {
   imageUrl: "",
   labelMode: "hidden"  // "always", "interact", "hidden"
 };
+var stateVersion = 0;
+var resyncPending = false;
 var connectedDisplays = [];
+var displayClocks = {};
 var library = [];
+var libraryTotal = 0;
+var librarySearch = "";
+var librarySearchTimer = null;
 var serverInfo = { lanIP: "", httpPort: 3000 };
 var pendingDeleteId = null;
+var libraryEntry = null; // Entry saves add revisions to, while the name is unchanged
 var currentMode = "builtin"; // "builtin" or "custom"
 var currentViewMode = "scenes"; // "scenes" or "canvas"
 var draggedDisplay = null;
@@ -212,8 +219,9 @@ function addElementToViewport(el) {
     selectElement(el);
     draggingElement = el;
     var rect = $("canvasViewport").getBoundingClientRect();
-    dragOffset.x = (e.clientX - rect.left) / editorScale - el.x;
-    dragOffset.y = (e.clientY - rect.top) / editorScale - el.y;
+    // Whole pixels, so dragged positions stay integers and tile names match on every side
+    dragOffset.x = Math.round((e.clientX - rect.left) / editorScale - el.x);
+    dragOffset.y = Math.round((e.clientY - rect.top) / editorScale - el.y);
   };
 
   el.dom = div;
@@ -251,18 +259,32 @@ function broadcastElements() {
 }
 
 // Image Upload Functions
+// Streams the raw file to the server over HTTP and calls back with its URL
+function uploadFile(file, callback) {
+  fetch("/upload", {
+    method: "POST",
+    headers: { "Content-Type": file.type || "application/octet-stream" },
+    body: file
+  }).then(function(res) {
+    if (!res.ok) throw new Error("HTTP " + res.status);
+    return res.json();
+  }).then(function(result) {
+    callback(result.url);
+  }).catch(function(err) {
+    addLog("Upload failed: " + err.message, "error");
+  });
+}
+
 function uploadCanvasImage(file) {
-  var reader = new FileReader();
-  reader.onload = function(ev) {
+  uploadFile(file, function(url) {
     if (ws && ws.readyState === 1) {
       ws.send(JSON.stringify({
         type: "canvas_upload",
-        image: ev.target.result,
+        url: url,
         canvasLayout: state.canvasLayout
       }));
     }
-  };
-  reader.readAsDataURL(file);
+  });
 }
 
 function loadCanvasImageUrl() {
@@ -293,6 +315,11 @@ function buildSceneGrid() {
     d.dataset.scene = s.id;
     d.innerHTML = '<div class="scene-icon">' + s.icon + '</div><div class="scene-name">' + s.name + '</div>';
     d.onclick = function() { selectBuiltinScene(s.id); };
+    d.title = "Right-click to preload on displays";
+    d.oncontextmenu = function(e) {
+      e.preventDefault();
+      preloadScenes([{ scene: s.id }]);
+    };
     grid.appendChild(d);
   });
 
@@ -302,14 +329,43 @@ function buildSceneGrid() {
     d.className = "scene custom-scene";
     d.dataset.type = "custom";
     d.dataset.id = item.id;
-    d.innerHTML = '<div class="scene-icon">&#128196;</div><div class="scene-name">' + item.name + '</div><span class="scene-delete" title="Delete">x</span>';
+    var revision = item.revisions > 1 ? ' <small>' + item.revision + '</small>' : '';
+    d.innerHTML = '<div class="scene-icon">&#128196;</div><div class="scene-name">' + item.name + revision + '</div><span class="scene-delete" title="Delete">x</span>';
     d.querySelector(".scene-name").onclick = function() { loadAndBroadcastCustom(item.id); };
+    d.title = "Right-click to preload on displays";
+    d.oncontextmenu = function(e) {
+      e.preventDefault();
+      preloadScenes([{ libraryId: item.id }]);
+    };
     d.querySelector(".scene-delete").onclick = function(e) {
       e.stopPropagation();
       confirmDelete(item.id, item.name);
     };
     grid.appendChild(d);
   });
+
+  // Library is paged; fetch the next page on demand
+  if (library.length < libraryTotal) {
+    var more = document.createElement("div");
+    more.className = "scene custom-scene";
+    more.innerHTML = '<div class="scene-icon">&#8230;</div><div class="scene-name">More (' + (libraryTotal - library.length) + ')</div>';
+    more.onclick = function() { queryLibrary(library.length); };
+    grid.appendChild(more);
+  }
+}
+
+// Have displays stage scenes in the background so switching to them is instant
+function preloadScenes(scenes) {
+  if (ws && ws.readyState === 1) {
+    ws.send(JSON.stringify({ type: "preload_scenes", scenes: scenes }));
+    addLog("Preloading " + scenes.map(function(s) { return s.scene || s.libraryId; }).join(", "), "sync");
+  }
+}
+
+function queryLibrary(offset) {
+  if (ws && ws.readyState === 1) {
+    ws.send(JSON.stringify({ type: "library_query", search: librarySearch, offset: offset }));
+  }
 }
 
 // Select built-in scene
@@ -344,6 +400,8 @@ function loadAndBroadcastCustom(id) {
   if (ws && ws.readyState === 1) {
     ws.send(JSON.stringify({ type: "load_from_library", id: id }));
   }
+  var item = library.find(function(item) { return item.id === id; });
+  libraryEntry = item ? { id: item.id, name: item.name } : null;
 
   currentMode = "custom";
   $("builtinControls").style.display = "none";
@@ -362,6 +420,7 @@ function showCustomEditor() {
   $("customControls").style.display = "block";
   $("htmlEditor").value = "";
   $("htmlName").value = "";
+  libraryEntry = null;
 
   document.querySelectorAll(".scene").forEach(function(el) {
     el.classList.remove("active");
@@ -678,7 +737,10 @@ function updateDisplaysList() {
     a.className = "display-link" + (c ? " connected" : "");
     a.href = "/d" + i;
     a.target = "_blank";
-    a.innerHTML = '<span>Display ' + i + '</span><span class="status">' + (c ? "Connected" : "Open") + '</span>';
+    var status = c ? "Connected" : "Open";
+    // Half the RTT bounds how far this display's flips can drift from the others
+    if (c && displayClocks[i]) status += " &plusmn;" + Math.round(displayClocks[i].rttMs / 2) + "ms";
+    a.innerHTML = '<span>Display ' + i + '</span><span class="status">' + status + '</span>';
     l.appendChild(a);
   }
 }
@@ -698,11 +760,25 @@ function broadcastHtml() {
   }
 }
 
+// Library items are shown by content hash; put the body in the editor
+function loadLibraryBody(hash) {
+  fetch("/library/" + hash + ".html").then(function(res) {
+    if (!res.ok) throw new Error("HTTP " + res.status);
+    return res.text();
+  }).then(function(html) {
+    if (state.customHash === hash) $("htmlEditor").value = html;
+  }).catch(function(err) {
+    addLog("Could not load library item: " + err.message, "error");
+  });
+}
+
 function saveToLibrary() {
   var h = $("htmlEditor").value;
   var n = $("htmlName").value || "Untitled";
   if (h && ws && ws.readyState === 1) {
-    ws.send(JSON.stringify({ type: "save_to_library", html: h, name: n }));
+    var msg = { type: "save_to_library", html: h, name: n };
+    if (libraryEntry && libraryEntry.name === n) msg.id = libraryEntry.id;
+    ws.send(JSON.stringify(msg));
   }
 }
 
@@ -721,12 +797,14 @@ function deleteFromLibrary() {
 }
 
 function connect() {
-  ws = new WebSocket((location.protocol === "https:" ? "wss:" : "ws:") + "//" + location.hostname + ":3001");
+  ws = new WebSocket((location.protocol === "https:" ? "wss:" : "ws:") + "//" + location.hostname + ":" + ((parseInt(location.port) || 80) + 1));
+  ws.binaryType = "arraybuffer";
 
   ws.onopen = function() {
     $("connBadge").className = "badge connected";
     $("connBadge").querySelector("span:last-child").textContent = "Online";
-    ws.send(JSON.stringify({ type: "register_control" }));
+    ws.send(JSON.stringify({ type: "register_control", encodings: DEFLATE_JSON ? ["deflate-json"] : [] }));
+    ws.send(JSON.stringify({ type: "metrics_subscribe" }));
   };
 
   ws.onclose = function() {
@@ -736,7 +814,31 @@ function connect() {
   };
 
   ws.onmessage = function(e) {
-    var msg = JSON.parse(e.data);
+    receiveFrame(e.data, handleMessage);
+  };
+
+  function handleMessage(msg) {
+    // This panel edits the default zone; other zones have their own versions
+    if (msg.zone) return;
+
+    if (msg.type === "state_patch") {
+      // Already covered by a snapshot (queued before a resync reply)
+      if (msg.version <= stateVersion) return;
+      if (msg.version !== stateVersion + 1) {
+        // Missed a patch - ask for a full snapshot instead
+        if (!resyncPending) {
+          resyncPending = true;
+          ws.send(JSON.stringify({ type: "request_state" }));
+        }
+        return;
+      }
+      stateVersion = msg.version;
+      // Handled below like a full update, with only the changed fields
+      msg = { type: "state_update", state: msg.changes, patch: true };
+    } else if (msg.type === "init" || msg.type === "state_update") {
+      stateVersion = msg.version || 0;
+      resyncPending = false;
+    }
 
     if (msg.type === "init" || msg.type === "state_update") {
       if (msg.lanIP) {
@@ -752,16 +854,21 @@ function connect() {
         $("speedVal").textContent = state.speed.toFixed(1);
         $("intensityVal").textContent = state.intensity.toFixed(1);
         if (state.customHtml) $("htmlEditor").value = state.customHtml;
+        else if (msg.state.customHash) loadLibraryBody(msg.state.customHash);
         if (state.customName) $("htmlName").value = state.customName;
 
-        // Update canvas mode if needed
-        if (state.canvasMode && currentViewMode === "canvas") {
+        // Update canvas mode if needed (patches only when the layout changed)
+        var layoutChanged = !msg.patch || "canvasMode" in msg.state || "canvasLayout" in msg.state;
+        if (state.canvasMode && currentViewMode === "canvas" && layoutChanged) {
           initCanvas();
         }
       }
       if (msg.connectedDisplays) connectedDisplays = msg.connectedDisplays;
       if (msg.library) {
-        library = msg.library;
+        library = msg.library.items;
+        libraryTotal = msg.library.total;
+        librarySearch = "";
+        $("librarySearch").value = "";
         buildSceneGrid();
       }
       updatePreview();
@@ -776,8 +883,31 @@ function connect() {
       }
     }
 
+    if (msg.type === "library_page" && msg.search === librarySearch) {
+      library = msg.offset ? library.concat(msg.items) : msg.items;
+      libraryTotal = msg.total;
+      buildSceneGrid();
+    }
+
+    if (msg.type === "library_saved") {
+      libraryEntry = { id: msg.id, name: msg.name };
+    }
+
     if (msg.type === "library_update") {
-      library = msg.library || [];
+      if (msg.added && msg.added.name.toLowerCase().indexOf(librarySearch.toLowerCase()) >= 0) {
+        library.unshift(msg.added);
+        libraryTotal++;
+      }
+      if (msg.updated) {
+        library = library.map(function(item) { return item.id === msg.updated.id ? msg.updated : item; });
+      }
+      if (msg.removed) {
+        if (libraryEntry && libraryEntry.id === msg.removed) libraryEntry = null;
+        var before = library.length;
+        library = library.filter(function(item) { return item.id !== msg.removed; });
+        libraryTotal -= before - library.length;
+      }
+      if (!librarySearch) libraryTotal = msg.total;
       buildSceneGrid();
     }
 
@@ -792,8 +922,38 @@ function connect() {
       }
     }
 
+    if (msg.type === "clock_status") {
+      displayClocks = msg.displays || {};
+      updateDisplaysList();
+    }
+
+    if (msg.type === "metrics") {
+      var rate = 0;
+      Object.keys(msg.messagesPerSec).forEach(function(t) { rate += msg.messagesPerSec[t]; });
+      $("metricsBody").textContent =
+        "msgs/s " + rate.toFixed(1) + "  handler p99 " + msg.handlerP99Ms + " ms\n" +
+        "fan-out p99 " + msg.fanoutP99Ms + " ms  loop lag " + msg.loopLagMs + " ms\n" +
+        "displays " + msg.displays + "  controls " + msg.controls + "\n" +
+        "syncs " + msg.syncs.allReady + " ready / " + msg.syncs.timedOut + " timeout / " + msg.syncs.preloaded + " preloaded";
+    }
+
+    if (msg.type === "zones_update") {
+      addLog("Zones: " + Object.keys(msg.zones).map(function(name) {
+        return name + " [" + msg.zones[name].displays.join(", ") + "]";
+      }).join(", "), "zones");
+    }
+
+    if (msg.type === "playlist_status") {
+      addLog(!msg.playing ? "Playlist stopped (" + msg.cues + " cues)"
+        : msg.index < 0 ? "Playlist waiting for first cue"
+        : "Playlist: cue " + (msg.index + 1) + "/" + msg.cues + (msg.loop ? " (loop)" : ""), "playlist");
+    }
+
     if (msg.type === "server_log") {
-      addLog(msg.message, msg.category);
+      (msg.entries || []).forEach(function(entry) {
+        var warn = entry.level === "warning" || entry.level === "error";
+        addLog(entry.message, warn ? "error" : entry.category);
+      });
     }
 
     if (msg.type === "image_uploaded" && msg.url) {
@@ -804,19 +964,24 @@ function connect() {
     }
 
     if (msg.type === "scene_image_uploaded" && msg.url) {
-      state.scene = "image";
-      state.imageUrl = msg.url;
-      state.mode = "builtin";
-      currentMode = "builtin";
-      document.querySelectorAll(".scene").forEach(function(el) {
-        el.classList.remove("active");
-        if (el.dataset.scene === "image") el.classList.add("active");
-      });
-      $("builtinControls").style.display = "block";
-      $("customControls").style.display = "none";
-      broadcast();
+      showSceneImage(msg.url);
     }
-  };
+  }
+}
+
+// Switch displays to the image scene showing url
+function showSceneImage(url) {
+  state.scene = "image";
+  state.imageUrl = url;
+  state.mode = "builtin";
+  currentMode = "builtin";
+  document.querySelectorAll(".scene").forEach(function(el) {
+    el.classList.remove("active");
+    if (el.dataset.scene === "image") el.classList.add("active");
+  });
+  $("builtinControls").style.display = "block";
+  $("customControls").style.display = "none";
+  broadcast();
 }
 
 // Event Bindings
@@ -867,6 +1032,14 @@ function bindEvents() {
 
   $("newCustomBtn").onclick = showCustomEditor;
 
+  $("librarySearch").oninput = function(e) {
+    clearTimeout(librarySearchTimer);
+    librarySearchTimer = setTimeout(function() {
+      librarySearch = e.target.value.trim();
+      queryLibrary(0);
+    }, 200);
+  };
+
   $("uploadFileBtn").onclick = function() {
     $("fileInput").click();
   };
@@ -942,18 +1115,9 @@ function bindEvents() {
   $("canvasFileInput").onchange = function(e) {
     var file = e.target.files[0];
     if (file) {
-      var reader = new FileReader();
-      reader.onload = function(ev) {
-        var base64 = ev.target.result;
-        if (ws && ws.readyState === 1) {
-          pendingImageElement = { base64: base64, w: 1920, h: 1080 };
-          ws.send(JSON.stringify({
-            type: "upload_image",
-            image: base64
-          }));
-        }
-      };
-      reader.readAsDataURL(file);
+      uploadFile(file, function(url) {
+        addElement("image", { src: url, w: 1920, h: 1080 });
+      });
     }
     // Reset so same file can be selected again
     e.target.value = "";
@@ -963,16 +1127,7 @@ function bindEvents() {
   $("sceneImageInput").onchange = function(e) {
     var file = e.target.files[0];
     if (file && pendingSceneImage) {
-      var reader = new FileReader();
-      reader.onload = function(ev) {
-        if (ws && ws.readyState === 1) {
-          ws.send(JSON.stringify({
-            type: "upload_scene_image",
-            image: ev.target.result
-          }));
-        }
-      };
-      reader.readAsDataURL(file);
+      uploadFile(file, showSceneImage);
     }
     pendingSceneImage = false;
     e.target.value = "";
@@ -10,6 +10,17 @@ var customContainer = document.getElementById("customContainer");
 var sceneIframe = null;
 var currentSceneSrc = "";
 
+// Preloaded scenes live in hidden iframes here, keyed by "scene:<name>" or
+// "library:<hash>"; the active one is made visible in place (moving an iframe
+// would reload it)
+var warmContainer = document.createElement("div");
+warmContainer.style.cssText = "position:absolute;inset:0;visibility:hidden;pointer-events:none;";
+customContainer.parentNode.insertBefore(warmContainer, customContainer.nextSibling);
+var warmFrames = {};
+var warmOrder = [];
+var activeWarmFrame = null;
+var PRELOAD_MAX = 4;
+
 // Get display ID from URL
 var displayId = parseInt(window.location.pathname.replace("/d", "")) || 1;
 document.getElementById("label").textContent = "D" + displayId;
@@ -25,6 +36,7 @@ var state = {
   text: "",
   displayCount: 3,
   customHtml: "",
+  customHash: "",
   canvasMode: false,
   canvasLayout: {},
   canvasElements: [],
@@ -34,6 +46,14 @@ var state = {
 var labelTimeout = null;
 var elementImages = {};
 
+// Canvas tiles: when the server can render them, fetch only this display's
+// crop of each image instead of the full file
+var tilesEnabled = false;
+var tileImages = {};
+var tileChanges = {};
+var TILE_SETTLE_MS = 300;
+var TILEABLE_SRC = /^\/canvas\/([0-9a-f]{64})\.(png|jpg|webp)$/;
+
 // Resize handler
 function resize() {
   canvas.width = window.innerWidth;
@@ -42,6 +62,110 @@ function resize() {
 resize();
 window.addEventListener("resize", resize);
 
+// Library items arrive as a content hash; the body is fetched once and then
+// served from the browser cache (the server marks it immutable)
+var libraryFetches = {};
+
+function libraryHtml(hash) {
+  if (!libraryFetches[hash]) {
+    libraryFetches[hash] = fetch("/library/" + hash + ".html").then(function(res) {
+      if (!res.ok) throw new Error("HTTP " + res.status);
+      return res.text();
+    }).finally(function() {
+      delete libraryFetches[hash];
+    });
+  }
+  return libraryFetches[hash];
+}
+
+// Preloading
+function preload(items) {
+  items.forEach(function(item) {
+    if (warmFrames[item.key]) return;
+    var frame = document.createElement("iframe");
+    frame.style.cssText = "position:absolute;inset:0;width:100%;height:100%;border:none;";
+    frame.warmKey = item.key;
+    frame.onload = function() {
+      // Library frames get their document once the body has been fetched
+      if (frame.hash && !frame.srcdoc) return;
+      frame.loaded = true;
+      reportWarm();
+    };
+    if (item.src) {
+      frame.src = item.src;
+    } else if (item.hash) {
+      frame.hash = item.hash;
+      libraryHtml(item.hash).then(function(html) {
+        frame.srcdoc = customHtmlDocument(html);
+      }).catch(function(err) {
+        console.error("[PRELOAD] " + item.key + ":", err);
+      });
+    } else {
+      frame.html = item.html;
+      frame.srcdoc = customHtmlDocument(item.html);
+    }
+    warmFrames[item.key] = frame;
+    warmOrder.push(item.key);
+    warmContainer.appendChild(frame);
+  });
+  // Evict the oldest frames that aren't on screen
+  while (warmOrder.length > PRELOAD_MAX) {
+    var key = warmOrder.find(function(k) { return warmFrames[k] !== activeWarmFrame && warmFrames[k] !== sceneIframe; });
+    if (!key) break;
+    warmOrder.splice(warmOrder.indexOf(key), 1);
+    warmFrames[key].remove();
+    delete warmFrames[key];
+  }
+  reportWarm();
+}
+
+function reportWarm() {
+  if (!ws || ws.readyState !== 1) return;
+  var warm = Object.keys(warmFrames).filter(function(key) { return warmFrames[key].loaded; });
+  ws.send(JSON.stringify({ type: "preload_status", warm: warm }));
+}
+
+function hideWarmFrame() {
+  if (activeWarmFrame) {
+    activeWarmFrame.style.visibility = "";
+    activeWarmFrame = null;
+  }
+}
+
+// Show the current scene: a warm frame in place, or the custom container
+function revealScene() {
+  if (canvasHeld) {
+    canvasHeld = false;
+    return;
+  }
+  if (sceneIframe && sceneIframe.warmKey) {
+    sceneIframe.style.visibility = "visible";
+    activeWarmFrame = sceneIframe;
+  } else {
+    customContainer.classList.add("active");
+  }
+}
+
+// Switch to a loaded warm frame; returns false if there isn't one
+function useWarmFrame(frame, sceneId) {
+  if (!frame || !frame.loaded) return false;
+  console.log("[SCENE] Using preloaded frame:", frame.warmKey);
+  hideWarmFrame();
+  customContainer.innerHTML = "";
+  customContainer.classList.remove("active");
+  canvas.style.display = "none";
+  document.getElementById("textOverlay").style.display = "none";
+  sceneIframe = frame;
+  sendStateToScene();
+  pendingSceneId = sceneId || null;
+  if (pendingSceneId) {
+    ws.send(JSON.stringify({ type: "scene_ready", sceneId: pendingSceneId }));
+  } else {
+    revealScene();
+  }
+  return true;
+}
+
 // Load scene from file
 var pendingSceneId = null;
 
@@ -56,8 +180,11 @@ function loadScene(sceneName, sceneId) {
     return;
   }
 
-  console.log("[SCENE] Loading from:", src);
   currentSceneSrc = src;
+  if (useWarmFrame(warmFrames["scene:" + sceneName], sceneId)) return;
+
+  console.log("[SCENE] Loading from:", src);
+  hideWarmFrame();
 
   // Hide current content while loading
   canvas.style.display = "none";
@@ -83,7 +210,7 @@ function loadScene(sceneName, sceneId) {
       ws.send(JSON.stringify({ type: "scene_ready", sceneId: pendingSceneId }));
     } else {
       // No sync, show immediately
-      customContainer.classList.add("active");
+      revealScene();
     }
   };
 
@@ -109,18 +236,100 @@ function sendStateToScene() {
   }
 }
 
-// Render custom HTML (inline)
-function renderCustomHtml() {
+// Wrap custom HTML in a full-screen document
+function customHtmlDocument(html) {
+  return "<!DOCTYPE html><html><head><meta charset='UTF-8'><style>*{margin:0;padding:0;box-sizing:border-box;}html,body{width:100%;height:100%;overflow:hidden;}</style></head><body>" + html + "</body></html>";
+}
+
+// Render custom HTML (inline); with a sceneId it stays hidden until show_scene
+function renderCustomHtml(sceneId) {
   currentSceneSrc = "";
+  // Reuse a preloaded library frame with the same HTML
+  for (var key in warmFrames) {
+    var frame = warmFrames[key];
+    var same = state.customHash ? frame.hash === state.customHash : frame.html === state.customHtml;
+    if (same && useWarmFrame(frame, sceneId)) return;
+  }
+  hideWarmFrame();
   canvas.style.display = "none";
   document.getElementById("textOverlay").style.display = "none";
   customContainer.innerHTML = "";
-  customContainer.classList.add("active");
+  pendingSceneId = sceneId || null;
+  customContainer.classList.toggle("active", !pendingSceneId);
 
   sceneIframe = document.createElement("iframe");
   sceneIframe.style.cssText = "width:100%;height:100%;border:none;";
-  sceneIframe.srcdoc = "<!DOCTYPE html><html><head><meta charset='UTF-8'><style>*{margin:0;padding:0;box-sizing:border-box;}html,body{width:100%;height:100%;overflow:hidden;}</style></head><body>" + state.customHtml + "</body></html>";
   customContainer.appendChild(sceneIframe);
+  if (pendingSceneId) {
+    // Set after appending, so the initial about:blank load doesn't count
+    var staged = sceneIframe;
+    staged.onload = function() {
+      if (sceneIframe === staged && pendingSceneId === sceneId) {
+        ws.send(JSON.stringify({ type: "scene_ready", sceneId: sceneId }));
+      }
+    };
+  }
+  if (state.customHash) {
+    var hash = state.customHash, target = sceneIframe;
+    libraryHtml(hash).then(function(html) {
+      if (sceneIframe === target) target.srcdoc = customHtmlDocument(html);
+    }).catch(function(err) {
+      console.error("[LIBRARY] " + hash + ":", err);
+    });
+  } else {
+    sceneIframe.srcdoc = customHtmlDocument(state.customHtml);
+  }
+}
+
+// Tile covering the visible part of an image element, or null (mirrors tile_name in server.py)
+function tileFor(el, offset) {
+  var m = TILEABLE_SRC.exec(el.src || "");
+  if (!m) return null;
+  var x = Math.round(el.x), y = Math.round(el.y), w = Math.round(el.w), h = Math.round(el.h);
+  var ox = Math.round(offset.x || 0), oy = Math.round(offset.y || 0);
+  var x0 = Math.max(x, ox), y0 = Math.max(y, oy);
+  var x1 = Math.min(x + w, ox + canvas.width), y1 = Math.min(y + h, oy + canvas.height);
+  if (x1 <= x0 || y1 <= y0) return null;
+  return {
+    url: "/canvas/tiles/" + m[1] + "_" + w + "x" + h + "_" + (x0 - x) + "_" + (y0 - y) + "_" + (x1 - x0) + "_" + (y1 - y0) + "." + m[2],
+    x: x0 - ox, y: y0 - oy, w: x1 - x0, h: y1 - y0
+  };
+}
+
+function loadImage(src) {
+  var img = new Image();
+  if (src.startsWith("/")) {
+    src = window.location.protocol + "//" + window.location.host + src;
+  }
+  img.src = src;
+  return img;
+}
+
+// Draw an element's tile; returns false to fall back to the full image
+function drawTile(el, offset) {
+  if (!TILEABLE_SRC.test(el.src || "")) return false;
+  var tile = tileFor(el, offset);
+  if (!tile) return true;  // Not visible on this display
+
+  // While an element is being dragged its tile changes every frame; wait for
+  // it to settle and show the full image (if already loaded) meanwhile
+  var now = Date.now();
+  var seen = tileChanges[el.src];
+  if (!seen) {
+    tileChanges[el.src] = { url: tile.url, time: 0 };
+  } else if (seen.url !== tile.url) {
+    tileChanges[el.src] = { url: tile.url, time: now };
+  }
+  if (!tileImages[tile.url] && now - tileChanges[el.src].time < TILE_SETTLE_MS) return false;
+
+  if (!tileImages[tile.url]) tileImages[tile.url] = loadImage(tile.url);
+  var img = tileImages[tile.url];
+  if (img.complete && img.naturalWidth > 0) {
+    ctx.drawImage(img, tile.x, tile.y, tile.w, tile.h);
+    return true;
+  }
+  var full = elementImages[el.src];
+  return !(full && full.complete && full.naturalWidth > 0);
 }
 
 // Render canvas mode (multi-display spanning)
@@ -139,14 +348,9 @@ function renderCanvas() {
       ctx.fillStyle = el.color;
       ctx.fillRect(x, y, el.w, el.h);
     } else if (el.type === "image" && el.src) {
+      if (tilesEnabled && drawTile(el, offset)) return;
       if (!elementImages[el.src]) {
-        var img = new Image();
-        var src = el.src;
-        if (src.startsWith("/")) {
-          src = window.location.protocol + "//" + window.location.hostname + ":3000" + src;
-        }
-        img.src = src;
-        elementImages[el.src] = img;
+        elementImages[el.src] = loadImage(el.src);
       }
       var img = elementImages[el.src];
       if (img.complete && img.naturalWidth > 0) {
@@ -159,31 +363,66 @@ function renderCanvas() {
 // Main render loop
 var lastScene = "";
 var lastMode = "";
-var lastCustomHtml = "";
+var lastCustom = "";
+// Set while a synced switch to the canvas waits for show_scene
+var canvasHeld = false;
+
+// What the state shows: "canvas", "custom" (library or inline HTML) or "scene"
+function displayMode() {
+  var custom = state.customHash || state.customHtml;
+  return state.canvasMode ? "canvas" : (state.mode === "custom" && custom ? "custom" : "scene");
+}
+
+// Stage what the state now shows, hidden, and report ready for sceneId;
+// show_scene then reveals it on every display at once
+function stageContent(sceneId) {
+  var mode = displayMode();
+  // render() sees the new mode as already handled and won't load it again unsynced
+  lastMode = mode;
+  lastScene = "";
+  lastCustom = "";
+  canvasHeld = false;
+  if (mode === "scene") {
+    loadScene(state.scene, sceneId);
+    lastScene = state.scene;
+  } else if (mode === "custom") {
+    renderCustomHtml(sceneId);
+    lastCustom = state.customHash || state.customHtml;
+  } else {
+    // The canvas is drawn every frame; keep the old content up until the flip
+    canvasHeld = true;
+    pendingSceneId = sceneId;
+    ws.send(JSON.stringify({ type: "scene_ready", sceneId: sceneId }));
+  }
+}
 
 function render() {
-  var currentMode = state.canvasMode ? "canvas" : (state.mode === "custom" && state.customHtml ? "custom" : "scene");
+  var custom = state.customHash || state.customHtml;
+  var currentMode = displayMode();
 
   // Detect mode change - reset scene tracking
   if (currentMode !== lastMode) {
     lastScene = "";
-    lastCustomHtml = "";
+    lastCustom = "";
     currentSceneSrc = "";
   }
 
   if (currentMode === "canvas") {
-    // Canvas mode - multi-display spanning
-    canvas.style.display = "block";
-    document.getElementById("textOverlay").style.display = "none";
-    customContainer.classList.remove("active");
-    customContainer.innerHTML = "";
-    sceneIframe = null;
-    renderCanvas();
+    // Canvas mode - multi-display spanning (not until show_scene for a synced switch)
+    if (!canvasHeld) {
+      canvas.style.display = "block";
+      document.getElementById("textOverlay").style.display = "none";
+      customContainer.classList.remove("active");
+      customContainer.innerHTML = "";
+      hideWarmFrame();
+      sceneIframe = null;
+      renderCanvas();
+    }
   } else if (currentMode === "custom") {
     // Custom HTML mode
-    if (state.customHtml !== lastCustomHtml) {
+    if (custom !== lastCustom) {
       renderCustomHtml();
-      lastCustomHtml = state.customHtml;
+      lastCustom = custom;
     }
   } else {
     // Scene mode - load from file
@@ -198,43 +437,126 @@ function render() {
   requestAnimationFrame(render);
 }
 
+// Clock sync: NTP-style offset to the server clock, taken from the
+// lowest-RTT of the recent samples
+var CLOCK_SAMPLES = 8;
+var CLOCK_INTERVAL_MS = 10000;
+var clockSamples = [];
+var clockOffset = 0;  // server time - local time (ms)
+var clockTimer = null;
+
+function localNow() {
+  return performance.timeOrigin + performance.now();
+}
+
+function sendClockSync() {
+  if (ws && ws.readyState === 1) {
+    ws.send(JSON.stringify({ type: "clock_sync", t0: localNow() }));
+  }
+}
+
+function startClockSync() {
+  clockSamples = [];
+  clearInterval(clockTimer);
+  // Quick burst to converge after connecting, then periodic refresh
+  for (var i = 0; i < 5; i++) setTimeout(sendClockSync, i * 200);
+  clockTimer = setInterval(sendClockSync, CLOCK_INTERVAL_MS);
+}
+
+function handleClockSync(msg) {
+  var t3 = localNow();
+  var rtt = (t3 - msg.t0) - (msg.t2 - msg.t1);
+  var offset = ((msg.t1 - msg.t0) + (msg.t2 - t3)) / 2;
+  clockSamples.push({ rtt: rtt, offset: offset });
+  if (clockSamples.length > CLOCK_SAMPLES) clockSamples.shift();
+  var best = clockSamples.reduce(function(a, b) { return b.rtt < a.rtt ? b : a; });
+  clockOffset = best.offset;
+  ws.send(JSON.stringify({ type: "clock_report", offset: best.offset, rtt: best.rtt }));
+}
+
+// Apply a full or partial state from the server
+var stateVersion = 0;
+var resyncPending = false;
+
+function applyState(changes, sceneId) {
+  Object.assign(state, changes);
+  updateLabel();
+  sendStateToScene();
+  // The server sends a sceneId when what's shown changes; load it with sync
+  if (sceneId) stageContent(sceneId);
+}
+
 // WebSocket connection
 function connect() {
-  ws = new WebSocket((location.protocol === "https:" ? "wss:" : "ws:") + "//" + location.hostname + ":3001");
+  ws = new WebSocket((location.protocol === "https:" ? "wss:" : "ws:") + "//" + location.hostname + ":" + ((parseInt(location.port) || 80) + 1));
+  ws.binaryType = "arraybuffer";
 
   ws.onopen = function() {
     document.getElementById("dot").classList.add("on");
-    ws.send(JSON.stringify({ type: "register_display", displayId: displayId }));
+    ws.send(JSON.stringify({
+      type: "register_display",
+      displayId: displayId,
+      encodings: DEFLATE_JSON ? ["deflate-json"] : [],
+      width: canvas.width,
+      height: canvas.height
+    }));
+    startClockSync();
+    reportWarm();
   };
 
   ws.onclose = function() {
     document.getElementById("dot").classList.remove("on");
-    setTimeout(connect, 2000);
+    clearInterval(clockTimer);
+    // Jittered so a whole wall doesn't reconnect in the same instant
+    setTimeout(connect, 1000 + Math.random() * 2000);
   };
 
   ws.onmessage = function(e) {
-    var msg = JSON.parse(e.data);
+    receiveFrame(e.data, handleMessage);
+  };
+
+  function handleMessage(msg) {
     if (msg.type === "init" || msg.type === "state_update") {
+      if (msg.type === "init") tilesEnabled = !!msg.tiles;
       if (msg.state) {
-        var oldScene = state.scene;
-        Object.assign(state, msg.state);
-        updateLabel();
-        sendStateToScene();
-        // If scene changed and we have a sceneId, load with sync
-        if (msg.sceneId && state.scene !== oldScene) {
-          loadScene(state.scene, msg.sceneId);
-          lastScene = state.scene;
+        stateVersion = msg.version || 0;
+        resyncPending = false;
+        // A fresh snapshot replaces any switch still waiting for show_scene
+        canvasHeld = false;
+        applyState(msg.state, msg.sceneId);
+      }
+    } else if (msg.type === "state_patch") {
+      // Already covered by a snapshot (queued before a resync reply)
+      if (msg.version <= stateVersion) return;
+      if (msg.version !== stateVersion + 1) {
+        // Missed a patch - ask for a full snapshot instead
+        if (!resyncPending) {
+          resyncPending = true;
+          ws.send(JSON.stringify({ type: "request_state" }));
         }
+        return;
       }
+      stateVersion = msg.version;
+      applyState(msg.changes, msg.sceneId);
     } else if (msg.type === "show_scene") {
-      // Server says all displays ready - show now!
+      // Server says all displays ready - show at the agreed server time
       console.log("[SCENE] show_scene received:", msg.sceneId);
       if (pendingSceneId === msg.sceneId) {
-        customContainer.classList.add("active");
-        pendingSceneId = null;
+        var sceneId = msg.sceneId;
+        var delay = msg.showAt ? msg.showAt - clockOffset - localNow() : 0;
+        setTimeout(function() {
+          if (pendingSceneId === sceneId) {
+            revealScene();
+            pendingSceneId = null;
+          }
+        }, Math.max(0, delay));
       }
+    } else if (msg.type === "preload") {
+      preload(msg.items || []);
+    } else if (msg.type === "clock_sync") {
+      handleClockSync(msg);
     }
-  };
+  }
 }
 
 // Fullscreen on double-click
@@ -0,0 +1,35 @@
+/**
+ * Display Sync - WebSocket frame decoding shared by the display and control pages
+ */
+
+// Large state frames can arrive as binary deflated JSON (we offer
+// "deflate-json" when the browser can inflate). Frames are handled strictly
+// in arrival order, so text waits behind any binary frame still inflating.
+// Chromium 80-102 has DecompressionStream but not "deflate-raw", so test for it.
+var DEFLATE_JSON = (function() {
+  try {
+    new DecompressionStream("deflate-raw");
+    return true;
+  } catch (err) {
+    return false;
+  }
+})();
+var inflating = Promise.resolve();
+var inflatingCount = 0;
+
+function receiveFrame(data, handle) {
+  if (typeof data === "string" && !inflatingCount) {
+    handle(JSON.parse(data));
+    return;
+  }
+  inflatingCount++;
+  inflating = inflating.then(function() {
+    if (typeof data === "string") return JSON.parse(data);
+    var stream = new Blob([data]).stream().pipeThrough(new DecompressionStream("deflate-raw"));
+    return new Response(stream).text().then(JSON.parse);
+  }).then(handle).catch(function(err) {
+    console.error("[WS] Bad frame:", err);
+  }).then(function() {
+    inflatingCount--;
+  });
+}
@@ -1,51 +1,341 @@
 """Display Sync Server - Custom HTML broadcast system for multi-display control."""
 
+import argparse
 import asyncio
+import base64
+import bisect
+import gzip
+import hashlib
 import json
+import math
+import multiprocessing
+import os
+import queue
+import re
+import signal
 import socket
 import sys
 import threading
 import time
 import uuid
-from collections import deque
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
 from pathlib import Path
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, unquote, urlsplit
+from urllib.request import urlopen
 
 try:
     import websockets
 except ImportError:
     import subprocess
-    subprocess.check_call(["pip", "install", "websockets", "-q"])
+    subprocess.check_call(["pip", "install", "websockets>=14", "-q"])
     import websockets
+# The asyncio server API (websocket.protocol, one-argument handlers) arrived in 14.0
+if int(websockets.__version__.split(".")[0]) < 14:
+    sys.exit(f"websockets {websockets.__version__} is too old; run: pip install -U 'websockets>=14'")
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import Opcode
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# WebSockets always listen on the port after the HTTP one (clients assume so)
 PORT_HTTP = 3000
-PORT_WS = 3001
-BASE_DIR = Path(__file__).parent
+PORT_WS = PORT_HTTP + 1
+BASE_DIR = Path(__file__).resolve().parent
 CUSTOM_DIR = BASE_DIR / "custom"
+# Library HTML bodies, stored once per content hash as <sha256>.html and
+# served (immutable) from /library/
+LIBRARY_BLOBS_DIR = CUSTOM_DIR / "blobs"
 CANVAS_DIR = BASE_DIR / "canvas"
 SCENES_DIR = BASE_DIR / "scenes"
+PLAYLIST_FILE = BASE_DIR / "playlist.json"
+STATE_DIR = BASE_DIR / "state"
+ZONES_FILE = BASE_DIR / "zones.json"
+# Displays not assigned to a named zone belong to this one
+DEFAULT_ZONE = "default"
+
+# HTTP: idle keep-alive connections are closed after this many seconds
+HTTP_KEEPALIVE_TIMEOUT = 15
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Static files are held in memory (with gzip/brotli variants) up to this size.
+# Larger ones are streamed from disk, uncompressed, in chunks of STATIC_CHUNK.
+STATIC_CACHE_BYTES = 64 * 1024 * 1024
+STATIC_CACHE_MAX_FILE = 8 * 1024 * 1024
+STATIC_CHUNK = 256 * 1024
+COMPRESSIBLE_TYPES = {"text/html", "text/css", "application/javascript", "application/json", "image/svg+xml"}
+
+# Image uploads stream over HTTP POST /upload in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# Canvas images are stored as <sha256><ext>. Unreferenced ones are collected
+# periodically, once they are older than the grace period.
+IMAGE_GC_INTERVAL = 600
+IMAGE_GC_GRACE = 3600
+CANVAS_REF = re.compile(r"/canvas/([\w.-]+)")
+# Canvas tiles: each display fetches only its own crop of a canvas image,
+# named /canvas/tiles/<hash>_<elW>x<elH>_<x>_<y>_<w>_<h><ext> (crop in element
+# units). Needs Pillow; without it displays fall back to the full image. Tiles
+# no connected display needs are collected with the images, after the same grace.
+TILES_DIR = CANVAS_DIR / "tiles"
+TILE_WORKERS = 2
+TILE_PREWARM_DELAY = 0.3
+TILE_MAX_SIDE = 16384
+TILE_NAME = re.compile(r"^([0-9a-f]{64})_(\d+)x(\d+)_(\d+)_(\d+)_(\d+)_(\d+)(\.(?:png|jpg|webp))$")
+DEFAULT_SCREEN = {"width": 1920, "height": 1080}
+IMAGE_TYPES = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+# Library listings are paged; clients ask for more with library_query
+LIBRARY_PAGE_SIZE = 50
+
+# Blocking disk and decode work (library files, image uploads, snapshots) runs
+# on this many threads, with at most BLOCKING_QUEUE more jobs waiting. Past
+# that, callers wait for a slot and stop reading from their own socket.
+BLOCKING_WORKERS = 4
+BLOCKING_QUEUE = 16
+# base64 images are decoded in slices of this many characters (a multiple of
+# 4) so the worker hands the GIL back to the event loop between them
+DECODE_CHUNK = 512 * 1024
+
+# Scene flips are scheduled this far ahead (scaled from display RTTs, within
+# these bounds) so every display can act on show_scene at the same instant
+SHOW_LEAD_MIN = 0.05
+SHOW_LEAD_MAX = 0.5
+CLOCK_STATUS_INTERVAL = 5
+
+# Scene sync timeout, derived from each display's recent load times
+# (p95 * margin + slack, clamped). The default applies until there's history.
+SYNC_TIMEOUT_DEFAULT = 2.0
+SYNC_TIMEOUT_MIN = 0.5
+SYNC_TIMEOUT_MAX = 10.0
+SYNC_TIMEOUT_MARGIN = 1.25
+SYNC_TIMEOUT_SLACK = 0.2
+SYNC_MIN_SAMPLES = 3
+SYNC_SAMPLES = 50
+
+# Displays keep at most this many scenes preloaded in hidden frames
+PRELOAD_MAX = 4
+
+# Playlist: cues last this long unless they say otherwise, and the next cue
+# is preloaded on displays this many seconds before it starts
+PLAYLIST_DEFAULT_DURATION = 30
+PLAYLIST_PREFETCH = 5
+# State fields a canvas cue sets; changing them while in canvas mode is a transition
+CANVAS_FIELDS = ("canvasLayout", "canvasElements", "canvasContent")
+
+# State snapshots: written once changes have been quiet for the debounce
+# period, and at least this often while they keep coming. Fields listed as
+# blobs are stored separately by content hash and only written when new.
+SNAPSHOT_DEBOUNCE = 0.5
+SNAPSHOT_MAX_DELAY = 5.0
+SNAPSHOT_BLOB_FIELDS = ("customHtml",)
+
+# Relay mode: reconnect to the primary after this delay (doubling up to the max)
+RELAY_RECONNECT_MIN = 1.0
+RELAY_RECONNECT_MAX = 30.0
+RELAY_CLOCK_SAMPLES = 8
+
+# WebSocket transport. Text frames of at least DEFLATE_MIN_SIZE are compressed
+# per connection (permessage-deflate); smaller ones aren't worth the CPU.
+# Clients that register with "encodings": ["deflate-json"] get messages of at
+# least BINARY_MIN_SIZE as binary frames holding deflated JSON, compressed
+# once and shared by every such recipient instead of once per connection.
+DEFLATE_MIN_SIZE = 512
+DEFLATE_LEVEL = 3
+DEFLATE_WINDOW_BITS = 12
+BINARY_MIN_SIZE = 2048
+BINARY_DEFLATE_LEVEL = 6
+BINARY_CACHE_FRAMES = 16
+
+# Reconnect storms: registrations are admitted at this rate (after an initial
+# burst), and connect/disconnect notices to controls are batched per window
+ADMIT_RATE = 200
+ADMIT_BURST = 50
+DISPLAYS_UPDATE_WINDOW = 0.1
+
+# Fan-out: each client drains its own bounded queue so a stalled display
+# can't hold up the rest of the wall.
+SEND_TIMEOUT = 2.0
+SEND_QUEUE_SIZE = 64
+
+# High-frequency updates (sliders, canvas drags) are merged per message type
+# and broadcast at most once per window. Set to 0 to broadcast every message.
+COALESCE_WINDOW = 0.016
+
+# Metrics (/metrics and the control panel feed): histogram buckets in
+# seconds, how often subscribed control panels get a snapshot, and how often
+# event-loop lag is sampled. Message types beyond the cap count as "other".
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+METRICS_INTERVAL = 2.0
+METRICS_MAX_TYPES = 64
+LOOP_LAG_INTERVAL = 0.5
+
+# Logging: lines below LOG_LEVEL are dropped. The rest are written to stdout
+# by a background thread and sent to control panels in batches. Sampled
+# streams (one per incoming message type) log at most LOG_SAMPLE_RATE lines
+# per second each.
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_LEVEL = "info"
+LOG_BATCH_WINDOW = 0.25
+LOG_SAMPLE_RATE = 5
+LOG_BACKLOG = 50
+LOG_TAG = re.compile(r"^\[([A-Z]+)")
+
+
+class LogPipeline:
+    """Leveled log entries, written to stdout off the event loop and batched to controls."""
+    def __init__(self, level):
+        self.level = LOG_LEVELS[level]
+        self.json = False
+        # Recent entries, replayed to control panels when they connect
+        self.backlog = deque(maxlen=LOG_BACKLOG)
+        self.pending = []
+        self.flush_task = None
+        self.samples = {}
+        self.lines = queue.SimpleQueue()
+        self.writer = None
+        self.counts = defaultdict(int)
+        self.sampled_out = 0
+
+    def log(self, msg, level="info", sample=None):
+        if LOG_LEVELS[level] < self.level:
+            return
+        if sample is not None:
+            skipped = self._sample(sample)
+            if skipped is None:
+                return
+            if skipped:
+                msg = f"{msg} (+{skipped} more)"
+        tag = LOG_TAG.match(msg)
+        entry = {"ts": round(time.time(), 3), "level": level, "category": tag.group(1).lower() if tag else "", "message": msg}
+        self.counts[level] += 1
+        self._write(entry)
+        self.backlog.append(entry)
+        self.pending.append(entry)
+        if not self.flush_task:
+            try:
+                self.flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+            except RuntimeError:
+                pass
+
+    def _sample(self, key):
+        """None if this line should be dropped, else how many were dropped since the last one."""
+        now = time.monotonic()
+        window = self.samples.get(key)
+        if not window or now - window[0] >= 1:
+            skipped = window[2] if window else 0
+            self.samples[key] = [now, 1, 0]
+            return skipped
+        if window[1] < LOG_SAMPLE_RATE:
+            window[1] += 1
+            skipped, window[2] = window[2], 0
+            return skipped
+        window[2] += 1
+        self.sampled_out += 1
+        return None
+
+    def _write(self, entry):
+        if self.json:
+            line = json.dumps(entry)
+        elif entry["level"] in ("warning", "error"):
+            line = f"{entry['level'].upper()} {entry['message']}"
+        else:
+            line = entry["message"]
+        self.lines.put(line)
+        if not self.writer:
+            self.writer = threading.Thread(target=self._writer, name="log-writer", daemon=True)
+            self.writer.start()
+
+    def _writer(self):
+        while True:
+            batch = [self.lines.get()]
+            while not self.lines.empty():
+                batch.append(self.lines.get_nowait())
+            done = None in batch
+            if done:
+                batch = batch[:batch.index(None)]
+            sys.stdout.write("".join(f"{line}\n" for line in batch))
+            sys.stdout.flush()
+            if done:
+                return
+
+    async def _flush_later(self):
+        await asyncio.sleep(LOG_BATCH_WINDOW)
+        self.flush_task = None
+        entries, self.pending = self.pending, []
+        await broadcast_to("control", {"type": "server_log", "entries": entries})
+
+    def close(self):
+        """Write out whatever is still queued for stdout."""
+        if self.writer:
+            self.lines.put(None)
+            self.writer.join(timeout=2)
+            self.writer = None
 
-# Log buffer for piping to control panel
-log_buffer = deque(maxlen=50)
-log_queue = asyncio.Queue() if hasattr(asyncio, 'Queue') else None
+    def to_dict(self):
+        return {"level": next(name for name, n in LOG_LEVELS.items() if n == self.level),
+                "lines": dict(self.counts), "sampledOut": self.sampled_out}
 
 
-def server_log(msg):
-    """Print to stdout and queue for websocket broadcast."""
-    print(msg, flush=True)
-    log_buffer.append(msg)
-    # Queue for async broadcast (will be processed by log broadcaster)
-    try:
-        if log_queue:
-            log_queue.put_nowait(msg)
-    except:
-        pass
+log_pipeline = LogPipeline(LOG_LEVEL)
+
+
+def server_log(msg, level="info", sample=None):
+    """Log a line to stdout and control panels.
+
+    A leading [TAG] becomes the entry's category. Pass sample (e.g. a message
+    type) for high-frequency lines so they're rate-limited per key.
+    """
+    log_pipeline.log(msg, level, sample)
 
 
 class State:
     """Global application state."""
+    # Wire name -> (attribute, coercion) for fields clients may set
+    FIELDS = {
+        "mode": ("mode", None),
+        "scene": ("scene", None),
+        "color": ("color", None),
+        "speed": ("speed", float),
+        "intensity": ("intensity", float),
+        "text": ("text", None),
+        "displayCount": ("display_count", int),
+        "customHtml": ("custom_html", None),
+        "customName": ("custom_name", None),
+        "customHash": ("custom_hash", None),
+        "canvasMode": ("canvas_mode", None),
+        "canvasLayout": ("canvas_layout", None),
+        "canvasContent": ("canvas_content", None),
+        "canvasElements": ("canvas_elements", None),
+        "imageUrl": ("image_url", None),
+        "labelMode": ("label_mode", None),
+    }
+
     def __init__(self):
+        self.version = 0
         self.mode = "builtin"  # "builtin" or "custom"
         self.scene = "none"
         self.color = "#3b82f6"
@@ -55,6 +345,8 @@ class State:
         self.display_count = 3
         self.custom_html = ""
         self.custom_name = ""
+        # Set instead of custom_html for library items; displays fetch /library/<hash>.html
+        self.custom_hash = ""
         self.canvas_mode = False
         self.canvas_layout = {}
         self.canvas_content = None
@@ -74,6 +366,7 @@ class State:
             "displayCount": self.display_count,
             "customHtml": self.custom_html,
             "customName": self.custom_name,
+            "customHash": self.custom_hash,
             "canvasMode": self.canvas_mode,
             "canvasLayout": self.canvas_layout,
             "canvasContent": self.canvas_content,
@@ -84,26 +377,738 @@ class State:
         }
 
     def update(self, data):
-        if "mode" in data: self.mode = data["mode"]
-        if "scene" in data: self.scene = data["scene"]
-        if "color" in data: self.color = data["color"]
-        if "speed" in data: self.speed = float(data["speed"])
-        if "intensity" in data: self.intensity = float(data["intensity"])
-        if "text" in data: self.text = data["text"]
-        if "displayCount" in data: self.display_count = int(data["displayCount"])
-        if "customHtml" in data: self.custom_html = data["customHtml"]
-        if "customName" in data: self.custom_name = data["customName"]
-        if "canvasMode" in data: self.canvas_mode = data["canvasMode"]
-        if "canvasLayout" in data: self.canvas_layout = data["canvasLayout"]
-        if "canvasContent" in data: self.canvas_content = data["canvasContent"]
-        if "canvasElements" in data: self.canvas_elements = data["canvasElements"]
-        if "imageUrl" in data: self.image_url = data["imageUrl"]
-        if "labelMode" in data: self.label_mode = data["labelMode"]
-
-
-state = State()
-clients = {}
-pending_scene = {"id": None, "ready": set(), "expected": set()}
+        """Apply wire-format fields and return only the ones that changed."""
+        changes = {}
+        for key, (attr, cast) in self.FIELDS.items():
+            if key not in data:
+                continue
+            value = cast(data[key]) if cast else data[key]
+            if getattr(self, attr) != value:
+                setattr(self, attr, value)
+                changes[key] = value
+        return changes
+
+    def fields(self, keys):
+        """Current wire-format values for the given field names."""
+        return {key: getattr(self, self.FIELDS[key][0]) for key in keys}
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (0 if empty)."""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(METRICS_BUCKETS, self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return METRICS_BUCKETS[-1] if self.count else 0
+
+    def lines(self, name, labels=""):
+        out = []
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS + ("+Inf",), self.counts):
+            cumulative += count
+            out.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+        suffix = f"{{{labels}}}" if labels else ""
+        out.append(f"{name}_sum{suffix} {self.sum}")
+        out.append(f"{name}_count{suffix} {self.count}")
+        return out
+
+
+class FanoutStats:
+    """Rolling per-broadcast fan-out latency (enqueue -> last recipient sent)."""
+    def __init__(self, maxlen=1000):
+        self.samples = deque(maxlen=maxlen)
+        self.histogram = Histogram()
+        self.broadcasts = 0
+        self.dropped = 0
+        self.timeouts = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.histogram.observe(seconds)
+
+    def to_dict(self):
+        samples = list(self.samples)
+        return {
+            "broadcasts": self.broadcasts,
+            "dropped": self.dropped,
+            "timeouts": self.timeouts,
+            "p50Ms": round(percentile(samples, 50) * 1000, 2),
+            "p99Ms": round(percentile(samples, 99) * 1000, 2),
+            "samples": len(samples)
+        }
+
+
+class SceneLoadStats:
+    """Rolling scene-load latencies (scene broadcast -> scene_ready) per display and scene."""
+    def __init__(self, maxlen):
+        self.by_display_scene = defaultdict(lambda: deque(maxlen=maxlen))
+        self.by_display = defaultdict(lambda: deque(maxlen=maxlen))
+        self.by_scene = defaultdict(lambda: deque(maxlen=maxlen))
+        self.all_ready = 0
+        self.timed_out = 0
+        self.preloaded = 0
+
+    def record(self, display_id, scene, seconds):
+        self.by_display_scene[(display_id, scene)].append(seconds)
+        self.by_display[display_id].append(seconds)
+        self.by_scene[scene].append(seconds)
+
+    def timeout_for(self, display_ids, scene):
+        """Timeout covering the slowest expected display, preferring history for this scene."""
+        worst = None
+        for display_id in display_ids:
+            samples = self.by_display_scene.get((display_id, scene))
+            if not samples or len(samples) < SYNC_MIN_SAMPLES:
+                samples = self.by_display.get(display_id)
+            if not samples or len(samples) < SYNC_MIN_SAMPLES:
+                # A display we know nothing about gets the default
+                return SYNC_TIMEOUT_DEFAULT
+            p95 = percentile(list(samples), 95)
+            worst = p95 if worst is None else max(worst, p95)
+        if worst is None:
+            return SYNC_TIMEOUT_DEFAULT
+        timeout = worst * SYNC_TIMEOUT_MARGIN + SYNC_TIMEOUT_SLACK
+        return min(SYNC_TIMEOUT_MAX, max(SYNC_TIMEOUT_MIN, timeout))
+
+    def to_dict(self):
+        def summary(samples):
+            samples = list(samples)
+            return {
+                "p50Ms": round(percentile(samples, 50) * 1000, 1),
+                "p95Ms": round(percentile(samples, 95) * 1000, 1),
+                "samples": len(samples)
+            }
+        return {
+            "allReady": self.all_ready,
+            "timedOut": self.timed_out,
+            "preloaded": self.preloaded,
+            "displays": {str(d): summary(v) for d, v in self.by_display.items()},
+            "scenes": {scene: summary(v) for scene, v in self.by_scene.items()}
+        }
+
+
+class Fanout:
+    """Tracks one broadcast until every recipient has sent or dropped it."""
+    def __init__(self, recipients):
+        self.pending = recipients
+        self.started = time.perf_counter()
+
+    def done(self):
+        self.pending -= 1
+        if self.pending == 0:
+            fanout_stats.record(time.perf_counter() - self.started)
+
+
+def label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Counters and histograms for /metrics and the control panel feed.
+
+    Recording is a few dict and list increments; everything else is computed
+    when someone scrapes or a control panel subscribes.
+    """
+    def __init__(self):
+        self.messages = defaultdict(int)
+        self.handler = defaultdict(Histogram)
+        # Text length of encoded frames, per recipient type
+        self.bytes_encoded = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        self.loop_lag = Histogram()
+        self.loop_lag_last = 0.0
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.upload_seconds = 0.0
+        self.last_feed = (time.perf_counter(), {"messages": {}, "sent": {}})
+
+    def observe_message(self, msg_type, seconds):
+        msg_type = str(msg_type)
+        if msg_type not in self.messages and len(self.messages) >= METRICS_MAX_TYPES:
+            msg_type = "other"
+        self.messages[msg_type] += 1
+        self.handler[msg_type].observe(seconds)
+
+    def observe_upload(self, size, seconds):
+        self.uploads += 1
+        self.upload_bytes += size
+        self.upload_seconds += seconds
+
+    def render(self):
+        """Prometheus text exposition."""
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples)
+
+        metric("display_sync_messages_total", "counter", "WebSocket messages received, by type",
+               [f'display_sync_messages_total{{type="{label(t)}"}} {n}' for t, n in self.messages.items()])
+        metric("display_sync_handler_seconds", "histogram", "Time to decode and handle one message, by type",
+               [line for t, h in self.handler.items() for line in h.lines("display_sync_handler_seconds", f'type="{label(t)}"')])
+        metric("display_sync_fanout_seconds", "histogram", "Broadcast enqueue until the last recipient sent it",
+               fanout_stats.histogram.lines("display_sync_fanout_seconds"))
+        metric("display_sync_fanout_dropped_total", "counter", "Messages dropped for backed-up clients",
+               [f"display_sync_fanout_dropped_total {fanout_stats.dropped}"])
+        metric("display_sync_bytes_encoded_total", "counter", "Encoded broadcast frames, by recipient type",
+               [f'display_sync_bytes_encoded_total{{client_type="{t}"}} {n}' for t, n in self.bytes_encoded.items()])
+        metric("display_sync_bytes_sent_total", "counter", "Bytes sent to clients, by client type",
+               [f'display_sync_bytes_sent_total{{client_type="{t}"}} {n}' for t, n in self.bytes_sent.items()])
+        metric("display_sync_loop_lag_seconds", "histogram", "Event loop scheduling delay",
+               self.loop_lag.lines("display_sync_loop_lag_seconds"))
+        metric("display_sync_blocking_seconds", "histogram", "Blocking-pool work: queue wait and run time, by operation",
+               blocking.lines())
+        metric("display_sync_blocking_waiting", "gauge", "Callers waiting for a blocking-pool slot",
+               [f"display_sync_blocking_waiting {blocking.waiting}"])
+        metric("display_sync_clients", "gauge", "Connected clients, by type",
+               [f'display_sync_clients{{client_type="{t}"}} {len(infos)}' for t, infos in clients.by_type.items()])
+        metric("display_sync_displays", "gauge", "Connected displays, including those behind relays",
+               [f"display_sync_displays {len(get_connected_displays())}"])
+        metric("display_sync_scene_syncs_total", "counter", "Scene sync handshakes, by outcome",
+               [f'display_sync_scene_syncs_total{{outcome="all_ready"}} {scene_load_stats.all_ready}',
+                f'display_sync_scene_syncs_total{{outcome="timeout"}} {scene_load_stats.timed_out}',
+                f'display_sync_scene_syncs_total{{outcome="preloaded"}} {scene_load_stats.preloaded}'])
+        metric("display_sync_uploads_total", "counter", "Streamed image uploads", [f"display_sync_uploads_total {self.uploads}"])
+        metric("display_sync_upload_bytes_total", "counter", "Streamed image upload bytes",
+               [f"display_sync_upload_bytes_total {self.upload_bytes}"])
+        metric("display_sync_upload_seconds_total", "counter", "Time spent receiving uploads",
+               [f"display_sync_upload_seconds_total {self.upload_seconds}"])
+        return "\n".join(out) + "\n"
+
+    def feed(self):
+        """Snapshot for control panels, with rates since the previous one."""
+        now = time.perf_counter()
+        totals = {"messages": dict(self.messages), "sent": dict(self.bytes_sent)}
+        last, self.last_feed = self.last_feed, (now, totals)
+        elapsed = max(now - last[0], 1e-9)
+
+        def rates(key):
+            return {k: round((n - last[1][key].get(k, 0)) / elapsed, 1) for k, n in totals[key].items()}
+
+        handler = Histogram()
+        for h in self.handler.values():
+            handler.counts = [a + b for a, b in zip(handler.counts, h.counts)]
+            handler.count += h.count
+        return {
+            "type": "metrics",
+            "messagesPerSec": rates("messages"),
+            "bytesSentPerSec": rates("sent"),
+            "handlerP99Ms": handler.quantile(0.99) * 1000,
+            "fanoutP99Ms": fanout_stats.to_dict()["p99Ms"],
+            "loopLagMs": round(self.loop_lag_last * 1000, 2),
+            "displays": len(get_connected_displays()),
+            "controls": len(clients.by_type["control"]),
+            "syncs": {"allReady": scene_load_stats.all_ready, "timedOut": scene_load_stats.timed_out,
+                      "preloaded": scene_load_stats.preloaded},
+            "uploadMBps": round(self.upload_bytes / self.upload_seconds / 1e6, 2) if self.upload_seconds else 0
+        }
+
+
+class FrameCache:
+    """Encoded frames for the current state version, shared by every recipient."""
+    def __init__(self, state):
+        self.state = state
+        self.version = None
+        self.frames = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        if self.version != self.state.version:
+            self.version = self.state.version
+            self.frames = {}
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+            frame = self.frames[key] = build()
+        else:
+            self.hits += 1
+        return frame
+
+    def to_dict(self):
+        return {"backend": "orjson" if orjson else "json", "hits": self.hits, "misses": self.misses}
+
+
+class SelectiveDeflate(PerMessageDeflate):
+    """permessage-deflate that leaves small text frames and binary frames alone.
+
+    Binary frames are already deflated (see BinaryFrames). RFC 7692 lets
+    each message be sent compressed or not; receivers check the RSV1 bit.
+    Counts what it compresses, for the connection's wire stats.
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.raw_bytes = 0
+        self.deflated_bytes = 0
+        self.seconds = 0.0
+
+    def encode(self, frame):
+        if frame.opcode == Opcode.BINARY or (frame.opcode == Opcode.TEXT and len(frame.data) < DEFLATE_MIN_SIZE):
+            return frame
+        started = time.perf_counter()
+        encoded = super().encode(frame)
+        if frame.opcode == Opcode.TEXT:
+            self.seconds += time.perf_counter() - started
+            self.raw_bytes += len(frame.data)
+            self.deflated_bytes += len(encoded.data)
+        return encoded
+
+
+class SelectiveDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response_params, ext = super().process_request_params(params, accepted_extensions)
+        return response_params, SelectiveDeflate(
+            ext.remote_no_context_takeover, ext.local_no_context_takeover,
+            ext.remote_max_window_bits, ext.local_max_window_bits, self.compress_settings
+        )
+
+
+class BinaryFrames:
+    """Deflated copies of recently sent frames, shared by every deflate-json client."""
+    def __init__(self, size):
+        self.size = size
+        self.frames = OrderedDict()
+        self.packed = 0
+        self.reused = 0
+        self.seconds = 0.0
+
+    def get(self, msg, stats):
+        frame = self.frames.get(msg)
+        if frame is None:
+            started = time.perf_counter()
+            deflate = zlib.compressobj(BINARY_DEFLATE_LEVEL, zlib.DEFLATED, -15)
+            frame = deflate.compress(msg.encode()) + deflate.flush()
+            elapsed = time.perf_counter() - started
+            self.packed += 1
+            self.seconds += elapsed
+            stats["encodeSeconds"] += elapsed
+            self.frames[msg] = frame
+            if len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+        else:
+            self.reused += 1
+            self.frames.move_to_end(msg)
+        return frame
+
+    def to_dict(self):
+        return {"packed": self.packed, "reused": self.reused, "encodeMs": round(self.seconds * 1000, 1)}
+
+
+class Coalescer:
+    """Merges bursts of state changes per message type into one patch per window.
+
+    State is updated immediately; only the broadcast is deferred. A flush
+    sends the current values of every field touched since the last one, so
+    patches from different message types can't overwrite each other out of order.
+    """
+    def __init__(self, window, zone):
+        self.window = window
+        self.zone = zone
+        self.pending = {}
+        self.tasks = {}
+        self.received = defaultdict(int)
+        self.coalesced = defaultdict(int)
+
+    async def submit(self, msg_type, changes, scene_id=None):
+        """Queue changed fields for broadcast; scene changes flush right away."""
+        self.received[msg_type] += 1
+        if not changes and not scene_id:
+            return
+        if msg_type in self.pending:
+            self.pending[msg_type].update(changes)
+            self.coalesced[msg_type] += 1
+        else:
+            self.pending[msg_type] = set(changes)
+        if scene_id or not self.window:
+            await self.flush_all(scene_id)
+        elif msg_type not in self.tasks:
+            self.tasks[msg_type] = asyncio.create_task(self._flush_later(msg_type))
+
+    async def _flush_later(self, msg_type):
+        await asyncio.sleep(self.window)
+        self.tasks.pop(msg_type, None)
+        await self.flush(msg_type)
+
+    async def flush(self, msg_type):
+        keys = self.pending.pop(msg_type, set())
+        task = self.tasks.pop(msg_type, None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
+        await publish(self.zone.state.fields(keys), zone=self.zone)
+
+    async def flush_all(self, scene_id=None):
+        """Broadcast everything pending as a single patch."""
+        keys = set()
+        for msg_type in list(self.pending):
+            keys |= self.pending.pop(msg_type)
+            task = self.tasks.pop(msg_type, None)
+            if task and task is not asyncio.current_task():
+                task.cancel()
+        await publish(self.zone.state.fields(keys), scene_id, self.zone)
+
+    def to_dict(self):
+        return {
+            "windowMs": self.window * 1000,
+            "received": dict(self.received),
+            "coalesced": dict(self.coalesced)
+        }
+
+
+class Zone:
+    """A group of displays with its own state and scene sync handshake.
+
+    Broadcasts for a zone only reach its member displays. The default zone
+    holds every display not assigned elsewhere (and any relays); it is the
+    one the control panel edits by default and the one that is snapshotted.
+    """
+    def __init__(self, name, display_ids=()):
+        self.name = name
+        self.display_ids = set(display_ids)
+        self.state = State()
+        self.pending = {"id": None, "ready": set(), "expected": set(), "scene": None, "started": 0}
+        # Last scene that timed out, so late scene_ready reports still count as samples
+        self.late = {"id": None, "missing": set(), "scene": None, "started": 0}
+        self.frames = FrameCache(self.state)
+        self.coalescer = Coalescer(COALESCE_WINDOW, self)
+        # Connected members, websocket -> client info
+        self.clients = {}
+
+    def tag(self, message):
+        """Mark a control-bound message with the zone it's about (unless default)."""
+        if self.name != DEFAULT_ZONE:
+            message["zone"] = self.name
+        return message
+
+    def to_dict(self):
+        return {
+            "displays": sorted(self.display_ids),
+            "connected": sorted((info["displayId"] for info in self.clients.values()), key=str),
+            "scene": self.state.scene,
+            "version": self.state.version
+        }
+
+
+class Batch:
+    """Runs a coroutine function once per window, however often it's triggered meanwhile."""
+    def __init__(self, window, func):
+        self.window = window
+        self.func = func
+        self.task = None
+        self.triggers = 0
+        self.runs = 0
+
+    def trigger(self):
+        self.triggers += 1
+        if not self.task:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await asyncio.sleep(self.window)
+        self.task = None
+        self.runs += 1
+        await self.func()
+
+
+class AdmissionPacer:
+    """Token bucket that spreads registrations out when many clients reconnect at once."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.admitted = 0
+        self.delayed = 0
+
+    async def wait(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Going negative reserves a later slot, so waiters are admitted in order
+        self.tokens -= 1
+        if self.tokens < 0:
+            self.delayed += 1
+            await asyncio.sleep(-self.tokens / self.rate)
+        self.admitted += 1
+
+    def to_dict(self):
+        return {"admitted": self.admitted, "delayed": self.delayed, "ratePerSec": self.rate}
+
+
+class ClientRegistry:
+    """Connected clients, indexed by type and display ID.
+
+    The indexes are updated on register and disconnect, so broadcasts and
+    display lists are lookups instead of scans over every connection.
+    """
+    def __init__(self):
+        self.all = {}
+        self.by_type = defaultdict(dict)
+        self.by_display = defaultdict(dict)
+        self.display_list = None
+        self.duplicate_registrations = 0
+
+    def add(self, websocket, info):
+        self.all[websocket] = info
+
+    def register(self, websocket, client_type, display_id=None):
+        """Set a client's type and display ID; returns other connections already using that display ID."""
+        info = self.all[websocket]
+        self._unindex(websocket, info)
+        info["type"] = client_type
+        info["displayId"] = display_id
+        self.by_type[client_type][websocket] = info
+        others = []
+        if client_type == "display":
+            others = list(self.by_display[display_id].values())
+            self.by_display[display_id][websocket] = info
+            if others:
+                self.duplicate_registrations += 1
+        return others
+
+    def remove(self, websocket):
+        info = self.all.pop(websocket, None)
+        if info:
+            self._unindex(websocket, info)
+        return info
+
+    def _unindex(self, websocket, info):
+        if info["type"]:
+            self.by_type[info["type"]].pop(websocket, None)
+        if info["type"] == "display":
+            same_id = self.by_display.get(info["displayId"], {})
+            same_id.pop(websocket, None)
+            if not same_id:
+                self.by_display.pop(info["displayId"], None)
+        self.display_list = None
+
+    def of_type(self, *client_types):
+        return [info for client_type in client_types for info in self.by_type[client_type].values()]
+
+    def displays_changed(self):
+        """A relay reported a different set of displays."""
+        self.display_list = None
+
+    def display_ids(self):
+        """Sorted connected display IDs, including those behind relays (cached until the next change)."""
+        if self.display_list is None:
+            ids = set(self.by_display)
+            for info in self.by_type["relay"].values():
+                ids.update(info.get("relayDisplays", ()))
+            self.display_list = sorted(ids)
+        return self.display_list
+
+    def to_dict(self):
+        return {
+            "connections": len(self.all),
+            "byType": {client_type: len(infos) for client_type, infos in self.by_type.items()},
+            "duplicateDisplayIds": sorted(d for d, infos in self.by_display.items() if len(infos) > 1),
+            "duplicateRegistrations": self.duplicate_registrations
+        }
+
+
+class StateStore:
+    """Crash-safe snapshots of State on disk, restored at startup.
+
+    The snapshot is written to a temp file and renamed into place, so a crash
+    mid-write leaves the previous one intact. Large fields live in
+    blobs/<sha256> and are referenced from the snapshot by hash.
+    """
+    def __init__(self, directory):
+        self.dir = directory
+        self.path = directory / "snapshot.json"
+        self.blob_dir = directory / "blobs"
+        self.dirty = asyncio.Event()
+        # One write at a time: they share snapshot.json.tmp, and each drops blobs the others may need
+        self.lock = asyncio.Lock()
+        self.saved_version = None
+        self.writes = 0
+        self.blob_writes = 0
+
+    def mark_dirty(self):
+        self.dirty.set()
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _write(self, snapshot, blobs):
+        """Write new blobs, then the snapshot, then drop blobs it no longer uses (runs in a thread)."""
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        for digest, data in blobs.items():
+            blob = self.blob_dir / digest
+            if not blob.exists():
+                self._write_atomic(blob, data)
+                self.blob_writes += 1
+        self._write_atomic(self.path, snapshot.encode())
+        for blob in self.blob_dir.iterdir():
+            if blob.name not in blobs:
+                blob.unlink(missing_ok=True)
+
+    async def save(self):
+        """Snapshot the current state; unchanged versions are skipped.
+
+        Waits for any save already in progress, so the shutdown save never
+        overlaps one from run().
+        """
+        async with self.lock:
+            await self._save()
+
+    async def _save(self):
+        if state.version == self.saved_version:
+            return
+        fields = state.to_dict()
+        fields.pop("sceneShowTime", None)
+        blobs, refs = {}, {}
+        for key in SNAPSHOT_BLOB_FIELDS:
+            value = fields.pop(key, None)
+            if value:
+                data = value.encode("utf-8")
+                digest = hashlib.sha256(data).hexdigest()
+                blobs[digest] = data
+                refs[key] = digest
+        # Serialize on the loop so later updates can't change it mid-write
+        snapshot = encode({"version": state.version, "saved": time.time(), "fields": fields, "blobs": refs})
+        version = state.version
+        try:
+            await blocking.run("snapshot", self._write, snapshot, blobs)
+        except OSError as e:
+            server_log(f"[STATE] Snapshot failed: {e}", "error")
+            return
+        self.saved_version = version
+        self.writes += 1
+
+    def restore(self):
+        """Load the last snapshot into state; returns whether there was one."""
+        try:
+            text = self.path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            server_log(f"[STATE] Could not restore {self.path}: {e}", "error")
+            return False
+        # A blob the snapshot refers to going missing is corruption, not "no snapshot"
+        try:
+            snapshot = json.loads(text)
+            fields = snapshot["fields"]
+            for key, digest in snapshot.get("blobs", {}).items():
+                fields[key] = (self.blob_dir / digest).read_text(encoding="utf-8")
+        except (OSError, ValueError, KeyError) as e:
+            server_log(f"[STATE] Could not restore {self.path}: {e}", "error")
+            return False
+        state.update(fields)
+        state.version = self.saved_version = int(snapshot.get("version", 0))
+        return True
+
+    async def run(self):
+        """Background task: debounce changes into snapshot writes."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.dirty.wait()
+            deadline = loop.time() + SNAPSHOT_MAX_DELAY
+            while True:
+                self.dirty.clear()
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.dirty.wait(), min(SNAPSHOT_DEBOUNCE, remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Keep snapshotting after a bad save; the next change retries it
+            try:
+                await self.save()
+            except Exception as e:
+                server_log(f"[STATE] Snapshot failed: {e!r}", "error")
+
+    def to_dict(self):
+        return {"version": self.saved_version, "writes": self.writes, "blobWrites": self.blob_writes}
+
+
+default_zone = Zone(DEFAULT_ZONE)
+zones = {DEFAULT_ZONE: default_zone}
+# Display ID -> named zone, for displays assigned to one
+display_zones = {}
+zones_save_lock = asyncio.Lock()
+# The default zone's parts, which most of the server works with
+state = default_zone.state
+pending_scene = default_zone.pending
+late_scene = default_zone.late
+frame_cache = default_zone.frames
+coalescer = default_zone.coalescer
+state_store = StateStore(STATE_DIR)
+clients = ClientRegistry()
+metrics = Metrics()
+admission = AdmissionPacer(ADMIT_RATE, ADMIT_BURST)
+fanout_stats = FanoutStats()
+scene_load_stats = SceneLoadStats(SYNC_SAMPLES)
+binary_frames = BinaryFrames(BINARY_CACHE_FRAMES)
+# Set when running as an edge relay (--relay)
+relay = None
+
+
+def encode(message):
+    """Encode a message as JSON text, using orjson when it's installed.
+
+    Values orjson refuses (integers past 64 bits, say) go through json instead,
+    so one odd field can't make the shared state unencodable.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(message).decode()
+        except TypeError:
+            pass
+    return json.dumps(message)
+
+
+def with_state(message, zone=None):
+    """Encode message with a zone's current version and state spliced in.
+
+    The state itself is encoded once per version and reused, so inits and
+    resyncs don't re-serialize customHtml for every client.
+    """
+    zone = zone or default_zone
+    state_json = zone.frames.get("state", lambda: encode(zone.state.to_dict()))
+    return f'{encode(message)[:-1]},"version":{zone.state.version},"state":{state_json}}}'
+
+
+def display_init(display_id, zone, shared=False):
+    """Encoded init for a display; everything but the display ID is cached per state version.
+
+    With shared=True the display ID (which display.js doesn't need) is left
+    out, so one frame and its deflated copy serve every display.
+    """
+    frame = zone.frames.get("init", lambda: with_state({"type": "init", "tiles": Image is not None}, zone))
+    return frame if shared else f'{{"displayId":{display_id},{frame[1:]}'
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for empty input)."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
 
 
 def get_local_ip():
@@ -119,478 +1124,2005 @@ def get_local_ip():
 
 
 def get_connected_displays():
-    """Get list of connected display IDs."""
-    return sorted([
+    """Get list of connected display IDs, including those behind relays."""
+    return clients.display_ids()
+
+
+async def send_displays_update():
+    """Tell controls which displays are connected, if that changed since the last notice."""
+    global last_displays_update
+    connected = get_connected_displays()
+    if connected != last_displays_update:
+        last_displays_update = connected
+        await broadcast_to("control", {"type": "displays_update", "connectedDisplays": connected})
+
+
+last_displays_update = None
+displays_update = Batch(DISPLAYS_UPDATE_WINDOW, send_displays_update)
+
+
+def get_sync_members(zone):
+    """Who must report scene_ready in a zone: its displays, plus one ack per relay with displays."""
+    return sorted((
         info["displayId"]
-        for info in clients.values()
-        if info.get("type") == "display" and info.get("displayId")
-    ])
+        for info in zone.clients.values()
+        if info.get("type") == "display" or info.get("relayDisplays")
+    ), key=str)
 
 
-def get_library():
-    """Get list of saved HTML files."""
-    CUSTOM_DIR.mkdir(exist_ok=True)
-    items = []
-    for f in CUSTOM_DIR.glob("*.html"):
-        meta_file = f.with_suffix(".json")
-        meta = {"name": f.stem, "created": f.stat().st_mtime}
-        if meta_file.exists():
-            try:
-                meta.update(json.loads(meta_file.read_text()))
-            except Exception:
-                pass
-        items.append({"id": f.stem, "name": meta.get("name", f.stem), "created": meta.get("created")})
-    return sorted(items, key=lambda x: x.get("created", 0), reverse=True)
+def zones_dict():
+    return {name: zone.to_dict() for name, zone in zones.items()}
 
 
-def save_to_library(name, html_content):
-    """Save HTML content to library."""
-    CUSTOM_DIR.mkdir(exist_ok=True)
-    file_id = f"{int(time.time())}_{uuid.uuid4().hex[:6]}"
-    html_file = CUSTOM_DIR / f"{file_id}.html"
-    meta_file = CUSTOM_DIR / f"{file_id}.json"
-    html_file.write_text(html_content, encoding="utf-8")
-    meta_file.write_text(json.dumps({"name": name, "created": time.time()}), encoding="utf-8")
-    return file_id
-
-
-def load_from_library(file_id):
-    """Load HTML content from library."""
-    html_file = CUSTOM_DIR / f"{file_id}.html"
-    meta_file = CUSTOM_DIR / f"{file_id}.json"
-    if html_file.exists():
-        name = file_id
-        if meta_file.exists():
+def load_zones():
+    """Recreate the named zones saved in zones.json."""
+    if not ZONES_FILE.exists():
+        return
+    try:
+        saved = json.loads(ZONES_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        server_log(f"[ZONE] Could not read {ZONES_FILE.name}: {e}", "error")
+        return
+    for name, display_ids in saved.items():
+        if name != DEFAULT_ZONE and display_ids:
+            zones[name] = Zone(name, (int(d) for d in display_ids))
+            for display_id in zones[name].display_ids:
+                display_zones[display_id] = zones[name]
+
+
+async def set_zone(name, display_ids):
+    """Assign displays to a named zone (no displays removes it) and move connected ones over."""
+    if not name or name == DEFAULT_ZONE:
+        return
+    try:
+        ids = {int(d) for d in display_ids}
+    except (TypeError, ValueError):
+        server_log(f"[ZONE] {name}: ignoring invalid display IDs {display_ids!r}", "warning")
+        return
+    before = list(zones.values())
+    zone = zones.get(name)
+    if ids and not zone:
+        zone = zones[name] = Zone(name)
+    elif not ids and zone:
+        del zones[name]
+    # A display belongs to one zone at a time
+    for other in list(zones.values()):
+        if other is not zone and other is not default_zone:
+            other.display_ids -= ids
+            if not other.display_ids:
+                del zones[other.name]
+    if ids:
+        zone.display_ids = ids
+    display_zones.clear()
+    for other in zones.values():
+        if other is not default_zone:
+            display_zones.update(dict.fromkeys(other.display_ids, other))
+
+    # Connected displays switch to their new zone's state
+    moved = []
+    for old in before + ([zone] if zone and zone not in before else []):
+        for websocket, info in list(old.clients.items()):
+            new = display_zones.get(info["displayId"], default_zone) if info.get("type") == "display" else old
+            if new is not old:
+                del old.clients[websocket]
+                new.clients[websocket] = info
+                info["zone"] = new
+                moved.append(info["displayId"])
+                enqueue(info, with_state({"type": "state_update"}, new))
+    server_log(f"[ZONE] {name}: {sorted(ids) or 'removed'}" + (f" (moved {sorted(moved)})" if moved else ""))
+    await broadcast_to("control", {"type": "zones_update", "zones": zones_dict()})
+    # The lock keeps overlapping changes from landing on disk out of order
+    async with zones_save_lock:
+        saved = json.dumps({other.name: sorted(other.display_ids) for other in zones.values() if other is not default_zone})
+        await blocking.run("zones_save", ZONES_FILE.write_text, saved, "utf-8")
+
+
+class BlockingPool:
+    """Bounded thread pool for blocking disk and decode work.
+
+    run() takes a slot before submitting, so a burst of uploads waits as
+    suspended handlers rather than piling up in the executor. Queue wait
+    (call -> worker start) and run time are tracked per operation.
+    """
+    def __init__(self, workers, queue_size):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="blocking")
+        self.slots = asyncio.Semaphore(workers + queue_size)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.waiting = 0
+        self.queued = defaultdict(Histogram)
+        self.ran = defaultdict(Histogram)
+        self.errors = defaultdict(int)
+
+    async def run(self, op, func, *args):
+        called = time.perf_counter()
+        started = None
+
+        def job():
+            nonlocal started
+            started = time.perf_counter()
+            return func(*args)
+
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, job)
+        except Exception:
+            self.errors[op] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+            if started is not None:
+                self.queued[op].observe(started - called)
+                self.ran[op].observe(time.perf_counter() - started)
+
+    def lines(self):
+        """Prometheus samples for Metrics.render."""
+        out = []
+        for op, h in self.queued.items():
+            out.extend(h.lines("display_sync_blocking_seconds", f'op="{op}",phase="queued"'))
+        for op, h in self.ran.items():
+            out.extend(h.lines("display_sync_blocking_seconds", f'op="{op}",phase="run"'))
+        return out
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+    def to_dict(self):
+        return {
+            "workers": self.workers,
+            "queueSize": self.queue_size,
+            "inFlight": self.in_flight,
+            "waiting": self.waiting,
+            "ops": {op: {
+                "count": h.count,
+                "queuedP99Ms": self.queued[op].quantile(0.99) * 1000,
+                "runP99Ms": h.quantile(0.99) * 1000,
+                "errors": self.errors[op]
+            } for op, h in self.ran.items()}
+        }
+
+
+blocking = BlockingPool(BLOCKING_WORKERS, BLOCKING_QUEUE)
+
+
+class LibraryIndex:
+    """In-memory index of saved HTML entries, newest first.
+
+    Built from disk once and kept current by save/delete. If files are
+    added or removed behind the server's back, the directory mtime changes
+    and the index is rebuilt (on a blocking-pool thread) on the next query.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.items = []
+        self.by_id = {}
+        self.dir_mtime = None
+
+    def _sort_key(self, item):
+        return -(item.get("created") or 0)
+
+    def _scan(self):
+        """Read every entry from disk, upgrading old-style ones; runs in a worker thread.
+
+        Returns (items, mtime, errors); errors are logged by the caller, on the event loop.
+        """
+        self.directory.mkdir(exist_ok=True)
+        errors = []
+        for html_file in self.directory.glob("*.html"):
             try:
-                name = json.loads(meta_file.read_text()).get("name", file_id)
-            except Exception:
-                pass
-        return {"name": name, "html": html_file.read_text(encoding="utf-8")}
-    return None
+                upgrade_library_entry(html_file)
+            except OSError as e:
+                errors.append(f"Could not upgrade {html_file.name}: {e}")
+        mtime = self.directory.stat().st_mtime_ns
+        items = []
+        for meta_file in self.directory.glob("*.json"):
+            try:
+                meta = json.loads(meta_file.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            if meta.get("revisions"):
+                items.append(index_item(meta_file.stem, meta))
+        return sorted(items, key=self._sort_key), mtime, errors
+
+    async def refresh(self):
+        try:
+            mtime = self.directory.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is None or mtime != self.dir_mtime:
+            self.items, self.dir_mtime, errors = await blocking.run("library_scan", self._scan)
+            for error in errors:
+                server_log(f"[LIBRARY] {error}", "error")
+            self.by_id = {item["id"]: item for item in self.items}
+
+    def _touched(self):
+        """Record our own change to the directory so it doesn't trigger a rescan."""
+        self.dir_mtime = self.directory.stat().st_mtime_ns
+
+    def put(self, file_id, meta):
+        """Add an entry or replace it with new metadata; returns its public form."""
+        item = index_item(file_id, meta)
+        old = self.by_id.get(file_id)
+        if old:
+            self.items[self.items.index(old)] = item
+        else:
+            bisect.insort(self.items, item, key=self._sort_key)
+        self.by_id[file_id] = item
+        self._touched()
+        return public_item(item)
+
+    def remove(self, file_id):
+        item = self.by_id.pop(file_id, None)
+        if item:
+            self.items.remove(item)
+        self._touched()
+        return item
+
+    async def query(self, search="", offset=0, limit=LIBRARY_PAGE_SIZE):
+        """One page of entries whose name contains search (case-insensitive)."""
+        await self.refresh()
+        items = self.items
+        if search:
+            needle = search.lower()
+            items = [item for item in items if needle in item["_search"]]
+        offset = max(0, offset)
+        limit = max(1, min(limit, LIBRARY_PAGE_SIZE * 10))
+        return {
+            "items": [public_item(item) for item in items[offset:offset + limit]],
+            "total": len(items),
+            "offset": offset,
+            "search": search
+        }
+
+
+def index_item(file_id, meta):
+    name = meta.get("name", file_id)
+    return {"id": file_id, "name": name, "created": meta.get("created"),
+            "revisions": meta["revisions"], "_search": name.lower()}
 
 
-def delete_from_library(file_id):
-    """Delete HTML content from library."""
-    html_file = CUSTOM_DIR / f"{file_id}.html"
-    meta_file = CUSTOM_DIR / f"{file_id}.json"
-    deleted = False
-    if html_file.exists():
-        html_file.unlink()
-        deleted = True
-    if meta_file.exists():
-        meta_file.unlink()
-    return deleted
-
-
-async def broadcast_to(client_type, message):
-    """Broadcast message to all clients of a specific type."""
-    msg = json.dumps(message)
-    for ws, info in list(clients.items()):
-        if info.get("type") == client_type:
+def public_item(item):
+    """Library entry without index-internal fields, described by its latest revision."""
+    latest = item["revisions"][-1]
+    return {"id": item["id"], "name": item["name"], "created": item["created"],
+            "hash": latest["hash"], "revision": latest["label"], "revisions": len(item["revisions"])}
+
+
+library_index = LibraryIndex(CUSTOM_DIR)
+
+
+def write_library_blob(html_content):
+    """Store an HTML body under its content hash (once); returns the hash."""
+    data = html_content.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = LIBRARY_BLOBS_DIR / f"{digest}.html"
+    if not path.exists():
+        LIBRARY_BLOBS_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{digest}.{uuid.uuid4().hex[:6]}.part")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+    return digest
+
+
+def write_library_meta(file_id, meta):
+    path = CUSTOM_DIR / f"{file_id}.json"
+    tmp = path.with_name(f".{file_id}.json.part")
+    tmp.write_text(json.dumps(meta), encoding="utf-8")
+    tmp.replace(path)
+
+
+def upgrade_library_entry(html_file):
+    """Move an old-style <id>.html body into the blob store as the entry's first revision."""
+    meta_file = html_file.with_suffix(".json")
+    meta = {"name": html_file.stem, "created": html_file.stat().st_mtime}
+    try:
+        meta.update(json.loads(meta_file.read_text(encoding="utf-8")))
+    except (OSError, ValueError):
+        pass
+    if not meta.get("revisions"):
+        digest = write_library_blob(html_file.read_text(encoding="utf-8"))
+        meta["revisions"] = [{"hash": digest, "label": "r1", "saved": meta["created"]}]
+        write_library_meta(html_file.stem, meta)
+    html_file.unlink()
+
+
+def delete_library_files(file_id, unused):
+    """Remove an entry's metadata and the bodies nothing else uses."""
+    (CUSTOM_DIR / f"{file_id}.json").unlink(missing_ok=True)
+    for digest in unused:
+        (LIBRARY_BLOBS_DIR / f"{digest}.html").unlink(missing_ok=True)
+
+
+async def save_to_library(name, html_content, label=None, file_id=None):
+    """Save HTML under name: a new revision of entry file_id if it exists, else a new entry.
+
+    Bodies are stored once per content hash, and saving the same HTML as
+    the latest revision changes nothing. Returns (entry, "added" | "updated"
+    | "unchanged").
+    """
+    await library_index.refresh()
+    digest = await blocking.run("library_save", write_library_blob, html_content)
+    now = time.time()
+    existing = library_index.by_id.get(file_id)
+    if existing:
+        revisions = existing["revisions"]
+        if revisions[-1]["hash"] == digest:
+            return public_item(existing), "unchanged"
+        file_id, status = existing["id"], "updated"
+        meta = {"name": name, "created": existing["created"], "revisions": revisions}
+    else:
+        file_id, status = f"{int(now)}_{uuid.uuid4().hex[:6]}", "added"
+        meta = {"name": name, "created": now, "revisions": []}
+    meta["revisions"] = meta["revisions"] + [{"hash": digest, "label": label or f"r{len(meta['revisions']) + 1}", "saved": now}]
+    await blocking.run("library_save", write_library_meta, file_id, meta)
+    return library_index.put(file_id, meta), status
+
+
+async def load_from_library(file_id, revision=None):
+    """Name and content hash of an entry's revision (label or hash; latest by default), or None."""
+    await library_index.refresh()
+    item = library_index.by_id.get(file_id)
+    if not item:
+        return None
+    revisions = item["revisions"]
+    if revision:
+        revisions = [r for r in revisions if revision in (r["label"], r["hash"])]
+    if not revisions:
+        return None
+    return {"name": item["name"], "hash": revisions[-1]["hash"], "revision": revisions[-1]["label"]}
+
+
+def library_fields(content):
+    """State fields that show a library revision; displays fetch the body by hash."""
+    return {"mode": "custom", "customHtml": "", "customHash": content["hash"], "customName": content["name"]}
+
+
+async def delete_from_library(file_id):
+    """Delete an entry and any bodies no other entry (or zone on screen) still uses."""
+    await library_index.refresh()
+    item = library_index.remove(file_id)
+    if not item:
+        return False
+    in_use = {r["hash"] for other in library_index.items for r in other["revisions"]}
+    in_use.update(zone.state.custom_hash for zone in zones.values())
+    unused = {r["hash"] for r in item["revisions"]} - in_use
+    await blocking.run("library_delete", delete_library_files, file_id, unused)
+    return True
+
+
+def store_image(image_bytes, ext):
+    """Write image bytes under their content hash (once) and return the URL.
+
+    Storing an image that's already there restarts its GC grace period, so
+    it can't be collected before whatever uploaded it again uses it.
+    """
+    CANVAS_DIR.mkdir(exist_ok=True)
+    file_id = f"{hashlib.sha256(image_bytes).hexdigest()}{ext}"
+    image_path = CANVAS_DIR / file_id
+    try:
+        os.utime(image_path)
+    except FileNotFoundError:
+        tmp_path = CANVAS_DIR / f".{file_id}.{uuid.uuid4().hex[:6]}.part"
+        tmp_path.write_bytes(image_bytes)
+        tmp_path.replace(image_path)
+    return f"/canvas/{file_id}"
+
+
+def store_base64_image(image_data, ext):
+    """Decode base64 image data (in slices, see DECODE_CHUNK) and store it."""
+    image_bytes = b"".join(
+        base64.b64decode(image_data[i:i + DECODE_CHUNK])
+        for i in range(0, len(image_data), DECODE_CHUNK)
+    )
+    return store_image(image_bytes, ext)
+
+
+def collect_images(in_use_json, tiles_in_use=frozenset(), grace=IMAGE_GC_GRACE):
+    """Delete canvas images referenced neither by a zone's state, the playlist nor the library.
+
+    in_use_json is the encoded state of every zone and the playlist cues, and tiles_in_use the
+    tile names connected displays currently show, both taken on the event loop so this can run
+    in a worker thread. Returns the names of removed files.
+    """
+    if not CANVAS_DIR.exists():
+        return []
+    referenced = set(CANVAS_REF.findall(in_use_json))
+    for html_file in LIBRARY_BLOBS_DIR.glob("*.html"):
+        try:
+            referenced.update(CANVAS_REF.findall(html_file.read_text(encoding="utf-8")))
+        except OSError:
+            pass
+    cutoff = time.time() - grace
+    removed = []
+    # Tiles go with their source image, or once no display has used them for a while
+    if TILES_DIR.exists():
+        for path in TILES_DIR.iterdir():
+            stem = path.name.split("_", 1)[0]
             try:
-                await ws.send(msg)
-            except Exception:
+                if (not any(CANVAS_DIR.glob(f"{stem}.*"))
+                        or path.name not in tiles_in_use and path.stat().st_mtime < cutoff):
+                    path.unlink()
+                    removed.append(f"tiles/{path.name}")
+            except OSError:
                 pass
+    for path in CANVAS_DIR.iterdir():
+        try:
+            if path.is_file() and path.name not in referenced and path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed.append(path.name)
+        except OSError:
+            pass
+    return removed
+
+
+def render_tile(source, target, el_w, el_h, crop):
+    """Crop the part of source shown in crop (element units) and scale it to display pixels.
+
+    Runs in the tile process pool.
+    """
+    vx, vy, vw, vh = crop
+    with Image.open(source) as img:
+        scale_x = img.width / el_w
+        scale_y = img.height / el_h
+        tile = img.crop((
+            round(vx * scale_x), round(vy * scale_y),
+            round((vx + vw) * scale_x), round((vy + vh) * scale_y)
+        ))
+        # Only ever shrink; the display's canvas upscales for free
+        if tile.width > vw or tile.height > vh:
+            tile = tile.resize((min(vw, tile.width), min(vh, tile.height)), Image.LANCZOS)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex[:6]}.part")
+        tile.save(tmp_path, format=img.format)
+        tmp_path.replace(target)
+
+
+def js_round(value):
+    """Round half up like JavaScript's Math.round (Python's round() is half-to-even)."""
+    return math.floor(float(value) + 0.5)
+
+
+def tile_name(element, offset, screen):
+    """Tile file name for an image element on one display, or None if it isn't visible there.
+
+    Mirrors tileFor() in display.js.
+    """
+    match = CANVAS_REF.fullmatch(element.get("src") or "")
+    stem, _, ext = (match.group(1) if match else "").partition(".")
+    if len(stem) != 64 or f".{ext}" not in (".png", ".jpg", ".webp"):
+        return None
+    try:
+        x, y, w, h = (js_round(element[key]) for key in ("x", "y", "w", "h"))
+        ox, oy = js_round(offset.get("x", 0)), js_round(offset.get("y", 0))
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+    x0, y0 = max(x, ox), max(y, oy)
+    x1, y1 = min(x + w, ox + screen["width"]), min(y + h, oy + screen["height"])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return f"{stem}_{w}x{h}_{x0 - x}_{y0 - y}_{x1 - x0}_{y1 - y0}.{ext}"
+
+
+class TileRenderer:
+    """Builds canvas tiles in a process pool, one job per distinct tile."""
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.jobs = {}
+        self.prewarm_task = None
+        self.rendered = 0
+
+    async def ensure(self, name):
+        """Make sure the named tile exists on disk; returns its path or None."""
+        match = TILE_NAME.match(name)
+        if not Image or not match:
+            return None
+        target = TILES_DIR / name
+        if target.exists():
+            return target
+        stem, el_w, el_h, vx, vy, vw, vh, ext = match.groups()
+        el_w, el_h, crop = int(el_w), int(el_h), tuple(int(v) for v in (vx, vy, vw, vh))
+        source = CANVAS_DIR / f"{stem}{ext}"
+        if not source.exists() and relay:
+            await relay.fetch("canvas", CANVAS_DIR, source.name)
+        if (not source.exists() or not 0 < el_w <= TILE_MAX_SIDE or not 0 < el_h <= TILE_MAX_SIDE
+                or crop[0] + crop[2] > el_w or crop[1] + crop[3] > el_h or 0 in crop[2:]):
+            return None
+        job = self.jobs.get(name)
+        if not job:
+            if not self.pool:
+                # Spawned, not forked, so workers don't inherit the listening sockets
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            loop = asyncio.get_running_loop()
+            job = self.jobs[name] = loop.run_in_executor(self.pool, render_tile, source, target, el_w, el_h, crop)
+            job.add_done_callback(lambda _: self.jobs.pop(name, None))
+        try:
+            await asyncio.shield(job)
+        except Exception as e:
+            server_log(f"[TILES] Failed to render {name}: {e}", "error")
+            return None
+        self.rendered += 1
+        return target
+
+    def schedule_prewarm(self):
+        """Render every connected display's tiles once the canvas stops changing."""
+        if not Image:
+            return
+        if self.prewarm_task:
+            self.prewarm_task.cancel()
+        self.prewarm_task = asyncio.create_task(self._prewarm())
+
+    async def _prewarm(self):
+        await asyncio.sleep(TILE_PREWARM_DELAY)
+        await asyncio.gather(*(self.ensure(name) for name in self.in_use()))
+
+    def in_use(self):
+        """Names of the tiles connected displays need for the current layout."""
+        names = set()
+        for zone in list(zones.values()):
+            for info in list(zone.clients.values()):
+                if info.get("type") == "display":
+                    names.update(self._tiles_for(info, zone.state))
+        return names
+
+    @staticmethod
+    def _tiles_for(info, state):
+        names = set()
+        offset = state.canvas_layout.get(f"d{info['displayId']}") or {}
+        for element in state.canvas_elements:
+            if element.get("type") == "image":
+                name = tile_name(element, offset, info.get("screen") or DEFAULT_SCREEN)
+                if name:
+                    names.add(name)
+        return names
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def to_dict(self):
+        return {"enabled": Image is not None, "rendered": self.rendered, "inFlight": len(self.jobs)}
+
+
+tile_renderer = TileRenderer(TILE_WORKERS)
+
+
+async def image_gc_loop():
+    """Background task to remove unreferenced canvas images."""
+    while True:
+        await asyncio.sleep(IMAGE_GC_INTERVAL)
+        # Every zone's screen, and cues that haven't played yet, still need their images
+        in_use = encode({"zones": [zone.state.to_dict() for zone in zones.values()], "playlist": playlist.cues})
+        tiles = tile_renderer.in_use()
+        removed = await blocking.run("image_gc", collect_images, in_use, tiles)
+        if removed:
+            server_log(f"[GC] Removed {len(removed)} unreferenced image(s) and tile(s)")
+
+
+async def broadcast_to(client_type, message, zone=None):
+    """Broadcast message to all clients of a specific type.
+
+    Messages are queued per client and sent concurrently by each client's
+    sender task, so this never waits on a slow display. Pass an already
+    encoded string to reuse one encoding across several broadcasts. Display
+    broadcasts can be limited to one zone's members.
+    """
+    msg = message if isinstance(message, str) else encode(message)
+    if client_type == "display" and zone:
+        targets = list(zone.clients.values())
+    else:
+        # Relays fan display traffic out to their own displays
+        targets = clients.of_type(client_type, "relay") if client_type == "display" else clients.of_type(client_type)
+    if not targets:
+        return
+    metrics.bytes_encoded[client_type] += len(msg)
+    fanout_stats.broadcasts += 1
+    fanout = Fanout(len(targets))
+    for info in targets:
+        enqueue(info, msg, fanout)
+
+
+def wire_frame(info, msg):
+    """What to send a client for an encoded message: the text, or a shared deflated binary copy."""
+    stats = info["wire"]
+    stats["textBytes"] += len(msg)
+    if info["encoding"] == "deflate-json" and len(msg) >= BINARY_MIN_SIZE:
+        msg = binary_frames.get(msg, stats)
+        stats["binaryFrames"] += 1
+    stats["sentBytes"] += len(msg)
+    return msg
+
+
+def wire_stats(info):
+    """Per-client transport summary for /api/stats.
+
+    sentBytes is message payload after both binary frames and permessage-deflate.
+    """
+    stats = info["wire"]
+    deflate = info["deflate"]
+    sent, seconds = stats["sentBytes"], stats["encodeSeconds"]
+    if deflate:
+        sent -= deflate.raw_bytes - deflate.deflated_bytes
+        seconds += deflate.seconds
+    return {
+        "client": describe_client(info),
+        "encoding": info["encoding"],
+        "permessageDeflate": deflate is not None,
+        "binaryFrames": stats["binaryFrames"],
+        "textBytes": stats["textBytes"],
+        "sentBytes": sent,
+        "savedPct": round(100 - 100 * sent / stats["textBytes"], 1) if stats["textBytes"] else 0,
+        "encodeMs": round(seconds * 1000, 2)
+    }
+
+
+def enqueue(info, msg, fanout=None):
+    """Queue an encoded message for one client, dropping it if the client is backed up."""
+    try:
+        info["queue"].put_nowait((msg, fanout))
+    except asyncio.QueueFull:
+        fanout_stats.dropped += 1
+        if not info.get("degraded"):
+            info["degraded"] = True
+            server_log(f"[FANOUT] {describe_client(info)} is backed up - dropping messages", "warning")
+        if fanout:
+            fanout.done()
+
+
+def describe_client(info):
+    """Short human-readable label for a client."""
+    if info.get("type") in ("display", "relay"):
+        return f"{info['type'].title()} {info.get('displayId')}"
+    return info.get("type") or "client"
+
+
+async def client_sender(websocket, info):
+    """Drain one client's outbound queue, closing it if a send stalls."""
+    queue = info["queue"]
+    while True:
+        msg, fanout = await queue.get()
+        msg = wire_frame(info, msg)
+        try:
+            await asyncio.wait_for(websocket.send(msg), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            fanout_stats.timeouts += 1
+            server_log(f"[FANOUT] {describe_client(info)} send timed out - disconnecting", "warning")
+            if fanout:
+                fanout.done()
+            # Pending sends are abandoned; the handler's finally block unregisters it
+            while not queue.empty():
+                _, stale = queue.get_nowait()
+                if stale:
+                    stale.done()
+            asyncio.create_task(websocket.close())
+            return
+        except Exception:
+            pass
+        else:
+            metrics.bytes_sent[info["type"]] += len(msg)
+        if fanout:
+            fanout.done()
+        if info.get("degraded") and queue.empty():
+            info["degraded"] = False
+            server_log(f"[FANOUT] {describe_client(info)} caught up")
+
+
+async def publish(changes, scene_id=None, zone=None):
+    """Send changed state fields to a zone's displays and to controls as a versioned patch.
+
+    Clients apply patches in version order and ask for a full snapshot
+    (request_state) when they see a gap.
+    """
+    if not changes and not scene_id:
+        return
+    zone = zone or default_zone
+    zone.state.version += 1
+    patch = zone.tag({"type": "state_patch", "version": zone.state.version, "changes": changes})
+    if scene_id:
+        patch["sceneId"] = scene_id
+    msg = zone.frames.get("patch", lambda: encode(patch))
+    await broadcast_to("display", msg, zone)
+    await broadcast_to("control", msg)
+    if zone is default_zone:
+        state_store.mark_dirty()
+    if "canvasElements" in changes or "canvasLayout" in changes:
+        tile_renderer.schedule_prewarm()
+
+
+def server_time_ms():
+    """Server clock in milliseconds, the timebase displays synchronize to."""
+    return time.time() * 1000
+
+
+def get_clock_status():
+    """Latest clock offset/RTT each display reported, keyed by display ID."""
+    return {
+        str(info["displayId"]): info["clock"]
+        for info in clients.of_type("display", "relay")
+        if info.get("clock")
+    }
+
+
+async def show_scene(scene_id, zone=None):
+    """Tell a zone's displays to reveal scene_id at a common server timestamp."""
+    zone = zone or default_zone
+    rtts = [info["clock"]["rttMs"] for info in zone.clients.values() if info.get("clock")]
+    lead = min(SHOW_LEAD_MAX, max(SHOW_LEAD_MIN, 1.5 * max(rtts, default=0) / 1000))
+    await broadcast_to("display", {
+        "type": "show_scene",
+        "sceneId": scene_id,
+        "showAt": server_time_ms() + lead * 1000
+    }, zone)
+
+
+async def loop_lag_monitor():
+    """Background task: measure how late the event loop wakes a sleeping task."""
+    loop = asyncio.get_running_loop()
+    while True:
+        before = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.loop_lag_last = max(0.0, loop.time() - before - LOOP_LAG_INTERVAL)
+        metrics.loop_lag.observe(metrics.loop_lag_last)
+
+
+async def metrics_feed():
+    """Background task: push metric snapshots to control panels that asked for them."""
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        subscribers = [info for info in clients.of_type("control") if info.get("metrics")]
+        if subscribers:
+            msg = encode(metrics.feed())
+            for info in subscribers:
+                enqueue(info, msg)
 
 
-async def log_broadcaster():
-    """Background task to broadcast logs to control panels."""
-    global log_queue
-    log_queue = asyncio.Queue()
+async def clock_status_broadcaster():
+    """Background task to push display clock skew to control panels."""
+    last = None
     while True:
-        msg = await log_queue.get()
-        await broadcast_to("control", {"type": "server_log", "message": msg})
+        await asyncio.sleep(CLOCK_STATUS_INTERVAL)
+        status = get_clock_status()
+        if status != last:
+            last = status
+            await broadcast_to("control", {"type": "clock_status", "displays": status})
 
 
-async def scene_sync_timeout(scene_id, timeout):
+async def scene_sync_timeout(scene_id, timeout, zone):
     """Force show scene after timeout if not all displays ready."""
     await asyncio.sleep(timeout)
-    if pending_scene["id"] == scene_id:
-        server_log("[SYNC] Timeout - forcing show_scene")
-        await broadcast_to("display", {"type": "show_scene", "sceneId": scene_id})
-        await broadcast_to("control", {"type": "sync_status", "status": "synced"})
+    pending = zone.pending
+    if pending["id"] == scene_id:
+        missing = pending["expected"] - pending["ready"]
+        server_log(f"[SYNC] Timeout after {timeout:.2f}s - forcing show_scene (missing {sorted(missing, key=str)})", "warning")
+        scene_load_stats.timed_out += 1
+        zone.late.update(
+            id=scene_id, missing=missing,
+            scene=pending["scene"], started=pending["started"]
+        )
+        await finish_sync(scene_id, zone)
+
+
+async def finish_sync(scene_id, zone=None):
+    """Reveal the pending scene across the zone and close the handshake."""
+    zone = zone or default_zone
+    await show_scene(scene_id, zone)
+    await broadcast_to("control", zone.tag({"type": "sync_status", "status": "synced"}))
+    zone.pending["id"] = None
+    zone.pending["ready"] = set()
+
+
+async def preload_item(entry):
+    """Describe one scene for displays to preload, or None if it doesn't exist.
+
+    entry is a built-in scene name, {"scene": name} or {"libraryId": id}
+    (optionally with a "revision").
+    """
+    if isinstance(entry, str):
+        entry = {"scene": entry}
+    if not isinstance(entry, dict):
+        return None
+    if entry.get("scene"):
+        name = str(entry["scene"])
+        if not resolve_under(SCENES_DIR / "default", f"{name}.html"):
+            return None
+        return {"key": f"scene:{name}", "src": f"/scenes/default/{name}.html"}
+    if entry.get("libraryId"):
+        content = await load_from_library(entry["libraryId"], entry.get("revision"))
+        if not content:
+            return None
+        return {"key": f"library:{content['hash']}", "hash": content["hash"]}
+    return None
+
+
+async def preload_scenes(entries, zone=None):
+    """Ask every display (or a zone's) to stage the given scenes in hidden frames."""
+    items = []
+    for entry in entries[:PRELOAD_MAX]:
+        item = await preload_item(entry)
+        if item:
+            items.append(item)
+    if items:
+        server_log(f"[PRELOAD] {', '.join(item['key'] for item in items)}")
+        await broadcast_to("display", {"type": "preload", "items": items}, zone)
+
+
+def all_warm(zone, key):
+    """Whether every display the zone's handshake expects reported key as preloaded."""
+    display_ids = zone.pending["expected"]
+    warm_by_display = {info["displayId"]: info.get("warm", ()) for info in zone.clients.values()}
+    return bool(display_ids) and all(key in warm_by_display.get(d, ()) for d in display_ids)
+
+
+def shown_content(zone_state):
+    """What a zone's displays show, keyed like preloads: scene:<name>, library:<hash>, custom or canvas.
+
+    Mirrors the mode choice in render() in display.js.
+    """
+    if zone_state.canvas_mode:
+        return "canvas"
+    if zone_state.mode == "custom" and zone_state.custom_hash:
+        return f"library:{zone_state.custom_hash}"
+    if zone_state.mode == "custom" and zone_state.custom_html:
+        return "custom"
+    return f"scene:{zone_state.scene}"
+
+
+async def apply_update(source, new_state, zone=None, sync_content=False):
+    """Apply a state update to a zone and broadcast it, running the scene sync handshake if the scene changed.
+
+    source names the message type (or "playlist") for coalescing. With
+    sync_content, any change to what displays show (library HTML, canvas
+    content, a mode switch) goes through the handshake too, not just a new scene.
+    """
+    zone = zone or default_zone
+    zone_state, pending = zone.state, zone.pending
+    shown = shown_content(zone_state)
+    changes = zone_state.update(new_state)
+    key = shown_content(zone_state)
+    # Stats and timeouts are per scene name for built-in scenes, per content key otherwise
+    label = zone_state.scene if key.startswith("scene:") else key
+    transition = "scene" in changes or sync_content and (
+        key != shown or key == "canvas" and not changes.keys().isdisjoint(CANVAS_FIELDS))
+
+    # Check if the content changed - initiate sync
+    scene_id = None
+    if transition:
+        connected = get_sync_members(zone)
+        if len(connected) > 0:
+            scene_id = f"{label}_{int(time.time()*1000)}"
+            pending["id"] = scene_id
+            pending["ready"] = set()
+            pending["expected"] = set(connected)
+            pending["scene"] = label
+            pending["started"] = time.perf_counter()
+            server_log(f"[SYNC] Scene: {label}, waiting for {connected}" + (f" in zone {zone.name}" if zone is not default_zone else ""))
+
+    # Every display already has the scene staged: no need to wait for ready
+    warm = scene_id and all_warm(zone, key)
+    if scene_id and not warm:
+        # Timeout: show scene even if not all ready, sized from past load times
+        timeout = scene_load_stats.timeout_for(pending["expected"], label)
+        asyncio.create_task(scene_sync_timeout(scene_id, timeout, zone))
+        # Notify control panel of sync start
+        await broadcast_to("control", zone.tag({
+            "type": "sync_status",
+            "status": "syncing",
+            "ready": 0,
+            "total": len(pending["expected"])
+        }))
+
+    await zone.coalescer.submit(source, changes, scene_id)
+    if warm:
+        server_log("[SYNC] Scene preloaded on all displays - showing now")
+        scene_load_stats.preloaded += 1
+        await finish_sync(scene_id, zone)
+
+
+class Playlist:
+    """Server-side cue list that drives scene changes from the event loop.
+
+    A cue is {"scene": name, ...other state fields}, {"libraryId": id} or
+    {"canvas": {canvasLayout, canvasElements}}, with an optional "duration"
+    (seconds) and "at" (absolute start, epoch seconds or ISO 8601). Cues are
+    timed against scheduled start times, not actual ones, so a long playlist
+    doesn't drift. It keeps running when control panels disconnect.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.cues = []
+        self.loop = True
+        self.index = -1
+        self.started_at = None
+        self.next_at = None
+        self.task = None
+
+    def load(self, cues, loop=True, save=True):
+        """Replace the cue list (stopping playback); invalid cues are dropped with a warning."""
+        self.stop()
+        self.cues = []
+        for number, cue in enumerate(cues, 1):
+            problem = self._invalid(cue)
+            if problem:
+                server_log(f"[PLAYLIST] Dropping cue {number}: {problem}", "warning")
+            else:
+                self.cues.append(cue)
+        self.loop = bool(loop)
+        if save:
+            self.path.write_text(json.dumps({"cues": self.cues, "loop": self.loop}, indent=2), encoding="utf-8")
+        return len(self.cues)
+
+    def load_file(self):
+        """Load the saved playlist, if any; returns whether there was one."""
+        if not self.path.exists():
+            return False
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            server_log(f"[PLAYLIST] Could not read {self.path.name}: {e}", "error")
+            return False
+        return self.load(data.get("cues", []), data.get("loop", True), save=False) > 0
+
+    def play(self, index=0):
+        self.stop()
+        if self.cues:
+            self.task = asyncio.create_task(self._run(index % len(self.cues)))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.index = -1
+        self.next_at = None
+
+    def skip(self):
+        if self.task:
+            self.play(self.index + 1)
+
+    @staticmethod
+    def _start_time(cue):
+        """A cue's absolute start (epoch seconds) or None; ValueError if "at" is malformed."""
+        at = cue.get("at")
+        if at is None:
+            return None
+        if isinstance(at, str):
+            at = datetime.fromisoformat(at).timestamp()
+        if isinstance(at, bool) or not isinstance(at, (int, float)) or not math.isfinite(at):
+            raise ValueError(f"bad start time {cue.get('at')!r}")
+        return float(at)
+
+    @classmethod
+    def _invalid(cls, cue):
+        """Why a cue can't be played, or None if it's fine."""
+        if not isinstance(cue, dict) or cls._preload_entry(cue) is False:
+            return "needs a scene, libraryId or canvas"
+        duration = cue.get("duration", PLAYLIST_DEFAULT_DURATION)
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)) or not 0 < duration < math.inf:
+            return f"bad duration {duration!r} (seconds)"
+        try:
+            cls._start_time(cue)
+        except (ValueError, OverflowError, OSError):
+            return f"bad start time {cue.get('at')!r} (epoch seconds or ISO 8601)"
+        return None
+
+    @staticmethod
+    def _preload_entry(cue):
+        """What to preload for a cue: an entry, None (nothing), or False if the cue is invalid."""
+        if cue.get("scene"):
+            return {"scene": cue["scene"]}
+        if cue.get("libraryId"):
+            return {"libraryId": cue["libraryId"], "revision": cue.get("revision")}
+        if isinstance(cue.get("canvas"), dict):
+            return None
+        return False
+
+    async def _run(self, index):
+        try:
+            await self._play_from(index)
+        except Exception as e:
+            server_log(f"[PLAYLIST] Stopped by an error: {e!r}", "error")
+        else:
+            server_log("[PLAYLIST] Finished")
+        self.task = None
+        self.index = -1
+        self.next_at = None
+        await self.broadcast_status()
+
+    async def _play_from(self, index):
+        deadline = time.time()
+        while True:
+            if index >= len(self.cues):
+                if not self.loop:
+                    break
+                index = 0
+            cue = self.cues[index]
+            at = self._start_time(cue)
+            if at is not None:
+                deadline = at
+            # Never replay a backlog: a late cue starts now
+            deadline = max(deadline, time.time())
+            await asyncio.sleep(deadline - time.time())
+
+            self.index = index
+            self.started_at = deadline
+            await self._apply(cue)
+            deadline += float(cue.get("duration", PLAYLIST_DEFAULT_DURATION))
+            self.next_at = deadline
+            await self.broadcast_status()
+
+            index += 1
+            if index >= len(self.cues) and not self.loop:
+                await asyncio.sleep(max(0, deadline - time.time()))
+                break
+            upcoming = self.cues[index % len(self.cues)]
+            entry = self._preload_entry(upcoming)
+            if entry and upcoming is not cue:
+                await asyncio.sleep(max(0, deadline - PLAYLIST_PREFETCH - time.time()))
+                await preload_scenes([entry])
+
+    async def _apply(self, cue):
+        server_log(f"[PLAYLIST] Cue {self.index + 1}/{len(self.cues)}")
+        # Every cue that changes what's on screen flips all displays together
+        if cue.get("scene"):
+            fields = {key: value for key, value in cue.items() if key in State.FIELDS}
+            await apply_update("playlist", {**fields, "mode": "builtin", "canvasMode": False}, sync_content=True)
+        elif cue.get("libraryId"):
+            content = await load_from_library(cue["libraryId"], cue.get("revision"))
+            if not content:
+                server_log(f"[PLAYLIST] Library item {cue['libraryId']} not found - skipping", "warning")
+                return
+            await apply_update("playlist", {**library_fields(content), "canvasMode": False}, sync_content=True)
+        else:
+            canvas = cue["canvas"]
+            update = {"canvasMode": True}
+            for key in CANVAS_FIELDS:
+                if key in canvas:
+                    update[key] = canvas[key]
+            await apply_update("playlist", update, sync_content=True)
+
+    def to_dict(self):
+        return {
+            "playing": self.task is not None,
+            "index": self.index,
+            "cues": len(self.cues),
+            "loop": self.loop,
+            "startedAt": self.started_at,
+            "nextAt": self.next_at
+        }
+
+    async def broadcast_status(self):
+        await broadcast_to("control", {"type": "playlist_status", **self.to_dict()})
+
+
+playlist = Playlist(PLAYLIST_FILE)
+
+
+class Relay:
+    """Edge relay: mirrors a primary server's state and serves it to local displays.
+
+    The relay registers upstream as a single client. It applies state patches
+    to its own copy (keeping the primary's version numbers) and forwards display
+    traffic to its displays unchanged. It answers scene_ready upstream once all
+    of its own displays are ready, so the primary waits for one ack per relay.
+    Canvas images are fetched from the primary's HTTP server on first use.
+    """
+    def __init__(self, url):
+        self.url = url
+        parts = urlsplit(url)
+        self.http_url = f"http://{parts.hostname}:{(parts.port or 80) - 1}"
+        self.name = f"{socket.gethostname()}:{PORT_HTTP}"
+        self.ws = None
+        self.clock_samples = deque(maxlen=RELAY_CLOCK_SAMPLES)
+        self.offset_ms = 0.0
+        self.rtt_ms = 0.0
+        self.fetches = {}
+        self.report = Batch(DISPLAYS_UPDATE_WINDOW, self.displays_changed)
+        self.patches = 0
+        self.resyncs = 0
+
+    async def run(self):
+        """Background task: stay connected to the primary."""
+        delay = RELAY_RECONNECT_MIN
+        while True:
+            try:
+                async with websockets.connect(self.url, max_size=50*1024*1024) as ws:
+                    self.ws = ws
+                    delay = RELAY_RECONNECT_MIN
+                    server_log(f"[RELAY] Connected to {self.url}")
+                    await self.send({"type": "register_relay", "name": self.name, "displays": get_connected_displays()})
+                    clock = asyncio.create_task(self._clock_loop())
+                    try:
+                        async for raw in ws:
+                            await self.handle(raw)
+                    finally:
+                        clock.cancel()
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                server_log(f"[RELAY] Upstream unavailable ({e}) - retrying in {delay:.0f}s", "warning")
+            self.ws = None
+            await asyncio.sleep(delay)
+            delay = min(RELAY_RECONNECT_MAX, delay * 2)
+
+    async def send(self, message):
+        if self.ws:
+            try:
+                await self.ws.send(encode(message))
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    async def handle(self, raw):
+        msg = json.loads(raw)
+        msg_type = msg.get("type")
+        if msg_type in ("init", "state_update"):
+            state.update(msg.get("state", {}))
+            state.version = msg.get("version", 0)
+            # Same version number, different content is possible after a resync
+            frame_cache.version = None
+            self.resyncs += 1
+            await broadcast_to("display", with_state({"type": "state_update"}))
+            if state.canvas_mode:
+                tile_renderer.schedule_prewarm()
+        elif msg_type == "state_patch":
+            version = msg.get("version", 0)
+            if version <= state.version:
+                return
+            if version != state.version + 1:
+                await self.send({"type": "request_state"})
+                return
+            changes = msg.get("changes", {})
+            state.update(changes)
+            state.version = version
+            self.patches += 1
+            if msg.get("sceneId"):
+                self.start_sync(msg["sceneId"])
+            await broadcast_to("display", raw)
+            if "canvasElements" in changes or "canvasLayout" in changes:
+                tile_renderer.schedule_prewarm()
+            if msg.get("sceneId") and not pending_scene["expected"]:
+                await self.scene_ready(msg["sceneId"])
+        elif msg_type == "show_scene":
+            # showAt is on the primary's clock; displays sync to ours
+            msg["showAt"] = msg["showAt"] - self.offset_ms
+            await broadcast_to("display", msg)
+        elif msg_type == "clock_sync":
+            t3 = server_time_ms()
+            t0, t1, t2 = msg.get("t0", t3), msg.get("t1", t3), msg.get("t2", t3)
+            self.clock_samples.append(((t3 - t0) - (t2 - t1), ((t1 - t0) + (t2 - t3)) / 2))
+            self.rtt_ms, self.offset_ms = min(self.clock_samples)
+        elif msg_type not in ("server_log", "displays_update"):
+            await broadcast_to("display", raw)
+
+    def start_sync(self, scene_id):
+        """Track scene_ready from our own displays for an upstream scene change."""
+        pending_scene["id"] = scene_id
+        pending_scene["ready"] = set()
+        pending_scene["expected"] = set(get_connected_displays())
+        pending_scene["scene"] = state.scene
+        pending_scene["started"] = time.perf_counter()
+
+    async def scene_ready(self, scene_id):
+        """All our displays are ready: acknowledge once upstream."""
         pending_scene["id"] = None
         pending_scene["ready"] = set()
+        await self.send({"type": "scene_ready", "sceneId": scene_id})
+
+    async def displays_changed(self):
+        """Report our displays (and what they all have preloaded) upstream."""
+        displays = clients.of_type("display")
+        warm = set.intersection(*(set(info.get("warm", ())) for info in displays)) if displays else set()
+        await self.send({"type": "relay_displays", "displays": get_connected_displays()})
+        await self.send({"type": "preload_status", "warm": sorted(warm)})
+
+    async def _clock_loop(self):
+        while True:
+            await self.send({"type": "clock_sync", "t0": server_time_ms()})
+            await asyncio.sleep(0.5 if len(self.clock_samples) < RELAY_CLOCK_SAMPLES else CLOCK_STATUS_INTERVAL)
+            # The primary sizes its show lead from this: upstream RTT plus our slowest display
+            local = [clock["rttMs"] for clock in get_clock_status().values()]
+            await self.send({"type": "clock_report", "offset": self.offset_ms, "rtt": self.rtt_ms + max(local, default=0)})
+
+    async def fetch(self, prefix, directory, name):
+        """Download /<prefix>/<name> (a canvas image or library body) from the primary into directory.
+
+        Returns whether it's now on disk.
+        """
+        target = directory / name
+        if "/" in name or target.exists():
+            return target.exists()
+        url_path = f"/{prefix}/{name}"
+        job = self.fetches.get(url_path)
+        if not job:
+            job = self.fetches[url_path] = asyncio.create_task(asyncio.to_thread(self._download, url_path, target))
+            job.add_done_callback(lambda _: self.fetches.pop(url_path, None))
+        try:
+            await asyncio.shield(job)
+        except OSError as e:
+            server_log(f"[RELAY] Could not fetch {url_path}: {e}", "error")
+            return False
+        return True
+
+    def _download(self, url_path, target):
+        with urlopen(f"{self.http_url}{url_path}", timeout=30) as response:
+            data = response.read()
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, target)
 
+    def to_dict(self):
+        return {
+            "upstream": self.url,
+            "connected": self.ws is not None,
+            "offsetMs": round(self.offset_ms, 2),
+            "rttMs": round(self.rtt_ms, 2),
+            "patches": self.patches,
+            "resyncs": self.resyncs
+        }
 
-async def handle_client(websocket):
-    """Handle WebSocket client connection."""
-    client_info = {"type": None, "displayId": None}
-    clients[websocket] = client_info
 
-    try:
-        async for message in websocket:
-            data = json.loads(message)
-            msg_type = data.get("type")
-            server_log(f"[MSG] {msg_type} from {client_info.get('type', 'unknown')}")
+async def handle_message(websocket, client_info, data):
+    """Dispatch one decoded message from a client."""
+    msg_type = data.get("type")
+    server_log(f"[MSG] {msg_type} from {client_info.get('type', 'unknown')}", "debug", msg_type)
+
+    if relay and client_info["type"] == "control":
+        # A relay only mirrors the primary; changes have to be made there
+        return
+
+    # Displays act in their own zone; controls name one per message (default if omitted)
+    zone = client_info.get("zone") or zones.get(data.get("zone") or DEFAULT_ZONE)
+    if not zone:
+        server_log(f"[ZONE] Unknown zone {data.get('zone')!r} - ignoring {msg_type}", "warning")
+        return
+
+    if msg_type in ("register_control", "register_display") and "deflate-json" in data.get("encodings", ()):
+        client_info["encoding"] = "deflate-json"
+
+    if msg_type == "register_control":
+        clients.register(websocket, "control")
+        await websocket.send(wire_frame(client_info, with_state({
+            "type": "init",
+            "connectedDisplays": get_connected_displays(),
+            "library": await library_index.query(),
+            "zones": zones_dict(),
+            "lanIP": get_local_ip(),
+            "httpPort": PORT_HTTP
+        })))
+        # Send log backlog
+        await websocket.send(encode({"type": "server_log", "entries": list(log_pipeline.backlog)}))
+
+    elif msg_type == "register_display":
+        display_id = int(data.get("displayId", 1))
+        await admission.wait()
+        if clients.register(websocket, "display", display_id):
+            server_log(f"[CLIENTS] Display {display_id} is connected more than once - check for duplicate display IDs", "warning")
+        if data.get("width") and data.get("height"):
+            client_info["screen"] = {"width": int(data["width"]), "height": int(data["height"])}
+        if client_info.get("zone"):
+            client_info["zone"].clients.pop(websocket, None)
+        zone = client_info["zone"] = display_zones.get(display_id, default_zone)
+        zone.clients[websocket] = client_info
+        shared = client_info["encoding"] == "deflate-json"
+        await websocket.send(wire_frame(client_info, display_init(display_id, zone, shared)))
+        if zone.state.canvas_mode:
+            tile_renderer.schedule_prewarm()
+        displays_update.trigger()
+        if relay:
+            relay.report.trigger()
+
+    elif msg_type == "register_relay":
+        client_info["relayDisplays"] = [int(d) for d in data.get("displays", [])]
+        clients.register(websocket, "relay", f"relay:{data.get('name', 'unknown')}")
+        client_info["zone"] = default_zone
+        default_zone.clients[websocket] = client_info
+        server_log(f"[RELAY] {client_info['displayId']} connected with displays {client_info['relayDisplays']}")
+        await websocket.send(with_state({"type": "init"}))
+        displays_update.trigger()
+
+    elif msg_type == "relay_displays":
+        client_info["relayDisplays"] = [int(d) for d in data.get("displays", [])]
+        clients.displays_changed()
+        displays_update.trigger()
+
+    elif msg_type == "metrics_subscribe":
+        client_info["metrics"] = bool(data.get("enabled", True))
+
+    elif msg_type == "clock_sync":
+        # NTP-style exchange: echo the client's t0 with receive/send times
+        received = server_time_ms()
+        await websocket.send(encode({
+            "type": "clock_sync",
+            "t0": data.get("t0"),
+            "t1": received,
+            "t2": server_time_ms()
+        }))
+
+    elif msg_type == "clock_report":
+        # Display's current best estimate (lowest-RTT sample)
+        client_info["clock"] = {
+            "offsetMs": round(float(data.get("offset", 0)), 2),
+            "rttMs": round(float(data.get("rtt", 0)), 2)
+        }
 
-            if msg_type == "register_control":
-                client_info["type"] = "control"
+    elif msg_type == "request_state":
+        # Client saw a version gap - resend the full snapshot, queued behind the
+        # patches already on their way. Wait for room rather than drop it; a
+        # client still full after SEND_TIMEOUT is disconnected by its sender.
+        frame = with_state({"type": "state_update"}, zone)
+        try:
+            await asyncio.wait_for(client_info["queue"].put((frame, None)), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    elif msg_type == "update_state":
+        await apply_update(msg_type, data.get("state", {}), zone)
+
+    elif msg_type == "zone_set":
+        await set_zone(str(data.get("name", "")), data.get("displays", []))
+
+    elif msg_type == "playlist_set":
+        count = playlist.load(list(data.get("cues", [])), data.get("loop", True))
+        server_log(f"[PLAYLIST] Loaded {count} cue(s)")
+        if data.get("play"):
+            playlist.play()
+        await playlist.broadcast_status()
+
+    elif msg_type == "playlist_play":
+        playlist.play(int(data.get("index", 0)))
+        await playlist.broadcast_status()
+
+    elif msg_type == "playlist_stop":
+        playlist.stop()
+        await playlist.broadcast_status()
+
+    elif msg_type == "playlist_skip":
+        playlist.skip()
+
+    elif msg_type == "preload_scenes":
+        await preload_scenes(list(data.get("scenes", [])), zone if "zone" in data else None)
+
+    elif msg_type == "preload_status":
+        # Display reports which scenes it has staged
+        client_info["warm"] = set(data.get("warm", []))
+        if relay:
+            relay.report.trigger()
+
+    elif msg_type == "save_to_library":
+        name = data.get("name", "Untitled")
+        html = data.get("html", "")
+        item, status = await save_to_library(name, html, data.get("revision"), data.get("id"))
+        server_log(f"[LIBRARY] {name!r} {item['revision']} ({status})")
+        # Tell the saving control which entry its next save should add a revision to
+        await websocket.send(encode({"type": "library_saved", "id": item["id"], "name": item["name"]}))
+        if status != "unchanged":
+            await broadcast_to("control", {
+                "type": "library_update",
+                status: item,
+                "total": len(library_index.items)
+            })
+
+    elif msg_type == "load_from_library":
+        file_id = data.get("id")
+        content = await load_from_library(file_id, data.get("revision"))
+        if content:
+            await publish(zone.state.update(library_fields(content)), zone=zone)
+
+    elif msg_type == "delete_from_library":
+        file_id = data.get("id")
+        await delete_from_library(file_id)
+        await broadcast_to("control", {
+            "type": "library_update",
+            "removed": file_id,
+            "total": len(library_index.items)
+        })
+
+    elif msg_type == "library_query":
+        page = await library_index.query(
+            str(data.get("search", "")),
+            int(data.get("offset", 0)),
+            int(data.get("limit", LIBRARY_PAGE_SIZE))
+        )
+        await websocket.send(encode({"type": "library_page", **page}))
+
+    elif msg_type == "broadcast_html":
+        await publish(zone.state.update({
+            "mode": "custom",
+            "customHtml": data.get("html", ""),
+            "customHash": "",
+            "customName": data.get("name", "Live")
+        }), zone=zone)
+
+    elif msg_type == "set_canvas_mode":
+        await publish(zone.state.update({"canvasMode": data.get("canvasMode", False)}), zone=zone)
+
+    elif msg_type == "update_canvas_layout":
+        changes = zone.state.update({"canvasLayout": data.get("canvasLayout", {})})
+        await zone.coalescer.submit(msg_type, changes)
+
+    elif msg_type == "upload_image":
+        try:
+            image_data = data.get("image", "")
+            server_log(f"[UPLOAD] Received image data: {len(image_data)} chars", "debug")
+            if image_data:
+                ext = ".png"
+                if image_data.startswith("data:image"):
+                    header, image_data = image_data.split(",", 1)
+                    if "jpeg" in header or "jpg" in header: ext = ".jpg"
+                    elif "gif" in header: ext = ".gif"
+                    elif "webp" in header: ext = ".webp"
+                url = await blocking.run("upload_decode", store_base64_image, image_data, ext)
+                server_log(f"[UPLOAD] Saved {url}")
                 await websocket.send(json.dumps({
-                    "type": "init",
-                    "state": state.to_dict(),
-                    "connectedDisplays": get_connected_displays(),
-                    "library": get_library(),
-                    "lanIP": get_local_ip(),
-                    "httpPort": PORT_HTTP
+                    "type": "image_uploaded",
+                    "url": url
                 }))
-                # Send log backlog
-                for log in log_buffer:
-                    await websocket.send(json.dumps({"type": "server_log", "message": log}))
-
-            elif msg_type == "register_display":
-                display_id = int(data.get("displayId", 1))
-                client_info["type"] = "display"
-                client_info["displayId"] = display_id
+        except Exception as e:
+            server_log(f"[UPLOAD] Failed: {e!r}", "error")
+
+    elif msg_type == "upload_scene_image":
+        try:
+            image_data = data.get("image", "")
+            if image_data:
+                ext = ".png"
+                if image_data.startswith("data:image"):
+                    header, image_data = image_data.split(",", 1)
+                    if "jpeg" in header or "jpg" in header: ext = ".jpg"
+                url = await blocking.run("upload_decode", store_base64_image, image_data, ext)
                 await websocket.send(json.dumps({
-                    "type": "init",
-                    "displayId": display_id,
-                    "state": state.to_dict()
+                    "type": "scene_image_uploaded",
+                    "url": url
                 }))
-                await broadcast_to("control", {
-                    "type": "displays_update",
-                    "connectedDisplays": get_connected_displays()
-                })
-
-            elif msg_type == "update_state":
-                new_state = data.get("state", {})
-                old_scene = state.scene
-                state.update(new_state)
-
-                # Check if scene changed - initiate sync
-                scene_id = None
-                if "scene" in new_state and new_state["scene"] != old_scene:
-                    connected = get_connected_displays()
-                    if len(connected) > 0:
-                        scene_id = f"{new_state['scene']}_{int(time.time()*1000)}"
-                        pending_scene["id"] = scene_id
-                        pending_scene["ready"] = set()
-                        pending_scene["expected"] = set(connected)
-                        server_log(f"[SYNC] Scene: {new_state['scene']}, waiting for {connected}")
-
-                msg = {"type": "state_update", "state": state.to_dict()}
-                if scene_id:
-                    msg["sceneId"] = scene_id
-                    # Timeout: show scene after 2s even if not all ready
-                    asyncio.create_task(scene_sync_timeout(scene_id, 2.0))
-                    # Notify control panel of sync start
-                    await broadcast_to("control", {
-                        "type": "sync_status",
-                        "status": "syncing",
-                        "ready": 0,
-                        "total": len(pending_scene["expected"])
-                    })
-
-                await broadcast_to("display", msg)
-                await broadcast_to("control", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-
-            elif msg_type == "save_to_library":
-                name = data.get("name", "Untitled")
-                html = data.get("html", "")
-                file_id = save_to_library(name, html)
-                await broadcast_to("control", {
-                    "type": "library_update",
-                    "library": get_library()
-                })
-
-            elif msg_type == "load_from_library":
-                file_id = data.get("id")
-                content = load_from_library(file_id)
-                if content:
-                    state.mode = "custom"
-                    state.custom_html = content["html"]
-                    state.custom_name = content["name"]
-                    await broadcast_to("display", {
-                        "type": "state_update",
-                        "state": state.to_dict()
-                    })
-                    await broadcast_to("control", {
-                        "type": "state_update",
-                        "state": state.to_dict()
-                    })
-
-            elif msg_type == "delete_from_library":
-                file_id = data.get("id")
-                delete_from_library(file_id)
-                await broadcast_to("control", {
-                    "type": "library_update",
-                    "library": get_library()
-                })
-
-            elif msg_type == "broadcast_html":
-                state.mode = "custom"
-                state.custom_html = data.get("html", "")
-                state.custom_name = data.get("name", "Live")
-                await broadcast_to("display", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-                await broadcast_to("control", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-
-            elif msg_type == "set_canvas_mode":
-                state.canvas_mode = data.get("canvasMode", False)
-                await broadcast_to("display", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-                await broadcast_to("control", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-
-            elif msg_type == "update_canvas_layout":
-                state.canvas_layout = data.get("canvasLayout", {})
-                await broadcast_to("display", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-                await broadcast_to("control", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-
-            elif msg_type == "upload_image":
-                try:
-                    import base64
-                    CANVAS_DIR.mkdir(exist_ok=True)
-                    image_data = data.get("image", "")
-                    print(f"[UPLOAD] Received image data: {len(image_data)} chars")
-                    if image_data:
-                        ext = ".png"
-                        if image_data.startswith("data:image"):
-                            header, image_data = image_data.split(",", 1)
-                            if "jpeg" in header or "jpg" in header: ext = ".jpg"
-                            elif "gif" in header: ext = ".gif"
-                            elif "webp" in header: ext = ".webp"
-                        file_id = f"{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
-                        image_path = CANVAS_DIR / file_id
-                        image_path.write_bytes(base64.b64decode(image_data))
-                        url = f"/canvas/{file_id}"
-                        print(f"[UPLOAD] Saved to {image_path}, URL: {url}")
-                        await websocket.send(json.dumps({
-                            "type": "image_uploaded",
-                            "url": url
-                        }))
-                        print(f"[UPLOAD] Response sent")
-                except Exception as e:
-                    import traceback
-                    print(f"[UPLOAD ERROR] {e}")
-                    traceback.print_exc()
-
-            elif msg_type == "upload_scene_image":
-                try:
-                    import base64
-                    CANVAS_DIR.mkdir(exist_ok=True)
-                    image_data = data.get("image", "")
-                    if image_data:
-                        ext = ".png"
-                        if image_data.startswith("data:image"):
-                            header, image_data = image_data.split(",", 1)
-                            if "jpeg" in header or "jpg" in header: ext = ".jpg"
-                        file_id = f"scene_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
-                        image_path = CANVAS_DIR / file_id
-                        image_path.write_bytes(base64.b64decode(image_data))
-                        url = f"/canvas/{file_id}"
-                        await websocket.send(json.dumps({
-                            "type": "scene_image_uploaded",
-                            "url": url
-                        }))
-                except Exception as e:
-                    print(f"[SCENE IMAGE ERROR] {e}")
-
-            elif msg_type == "scene_ready":
-                # Display reports scene loaded
-                scene_id = data.get("sceneId")
-                display_id = client_info.get("displayId")
-                if scene_id and display_id and scene_id == pending_scene["id"]:
-                    pending_scene["ready"].add(display_id)
-                    ready_count = len(pending_scene["ready"])
-                    total_count = len(pending_scene["expected"])
-                    server_log(f"[SYNC] Display {display_id} ready ({ready_count}/{total_count})")
-                    # Update control panel
-                    await broadcast_to("control", {
-                        "type": "sync_status",
-                        "status": "syncing",
-                        "ready": ready_count,
-                        "total": total_count
-                    })
-                    # Check if all displays are ready
-                    if pending_scene["ready"] >= pending_scene["expected"]:
-                        server_log("[SYNC] All ready - showing scene")
-                        await broadcast_to("display", {"type": "show_scene", "sceneId": scene_id})
-                        await broadcast_to("control", {"type": "sync_status", "status": "synced"})
-                        pending_scene["id"] = None
-                        pending_scene["ready"] = set()
-
-            elif msg_type == "canvas_elements":
-                state.canvas_elements = data.get("elements", [])
-                if "canvasLayout" in data:
-                    state.canvas_layout = data["canvasLayout"]
-                await broadcast_to("display", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-
-            elif msg_type == "canvas_content":
-                state.canvas_content = data.get("content")
-                if "canvasLayout" in data:
-                    state.canvas_layout = data["canvasLayout"]
-                await broadcast_to("display", {
-                    "type": "state_update",
-                    "state": state.to_dict()
-                })
-
-            elif msg_type == "canvas_upload":
-                import base64
-                CANVAS_DIR.mkdir(exist_ok=True)
-                print(f"[DEBUG] Canvas upload received")
-
-                # Update canvas layout if provided
-                if "canvasLayout" in data:
-                    state.canvas_layout = data["canvasLayout"]
-                    print(f"[DEBUG] Canvas layout updated: {state.canvas_layout}")
-
-                url = data.get("url", "")
-                print(f"[DEBUG] URL from message: {url}")
-
-                # Handle base64 image upload
-                image_data = data.get("image", "")
-                print(f"[DEBUG] Image data received: {len(image_data) if image_data else 0} chars")
-
-                if image_data:
-                    # Detect image format from data URL
+        except Exception as e:
+            server_log(f"[UPLOAD] Scene image failed: {e!r}", "error")
+
+    elif msg_type == "scene_ready":
+        # Display reports scene loaded
+        scene_id = data.get("sceneId")
+        display_id = client_info.get("displayId")
+        pending, late = zone.pending, zone.late
+        if scene_id and display_id and scene_id == late["id"] and display_id in late["missing"]:
+            late["missing"].discard(display_id)
+            scene_load_stats.record(display_id, late["scene"], time.perf_counter() - late["started"])
+        if scene_id and display_id and scene_id == pending["id"]:
+            scene_load_stats.record(display_id, pending["scene"], time.perf_counter() - pending["started"])
+            pending["ready"].add(display_id)
+            ready_count = len(pending["ready"])
+            total_count = len(pending["expected"])
+            server_log(f"[SYNC] Display {display_id} ready ({ready_count}/{total_count})", "debug")
+            # Update control panel
+            await broadcast_to("control", zone.tag({
+                "type": "sync_status",
+                "status": "syncing",
+                "ready": ready_count,
+                "total": total_count
+            }))
+            # Check if all displays are ready
+            if pending["ready"] >= pending["expected"]:
+                scene_load_stats.all_ready += 1
+                if relay:
+                    # The primary decides when to show it
+                    await relay.scene_ready(scene_id)
+                else:
+                    server_log("[SYNC] All ready - showing scene")
+                    await finish_sync(scene_id, zone)
+
+    elif msg_type == "canvas_elements":
+        update = {"canvasElements": data.get("elements", [])}
+        if "canvasLayout" in data:
+            update["canvasLayout"] = data["canvasLayout"]
+        await zone.coalescer.submit(msg_type, zone.state.update(update))
+
+    elif msg_type == "canvas_content":
+        update = {"canvasContent": data.get("content")}
+        if "canvasLayout" in data:
+            update["canvasLayout"] = data["canvasLayout"]
+        await zone.coalescer.submit(msg_type, zone.state.update(update))
+
+    elif msg_type == "canvas_upload":
+        # Update canvas layout if provided
+        update = {}
+        if "canvasLayout" in data:
+            update["canvasLayout"] = data["canvasLayout"]
+
+        url = data.get("url", "")
+
+        # Handle base64 image upload
+        image_data = data.get("image", "")
+        server_log(f"[CANVAS] Upload: url={url!r}, {len(image_data or '')} chars of image data", "debug")
+
+        if image_data:
+            # Detect image format from data URL
+            extension = ".png"
+            if image_data.startswith("data:image"):
+                header, image_data = image_data.split(",", 1)
+                # Extract format (e.g., "data:image/jpeg;base64" -> ".jpeg")
+                if "image/jpeg" in header or "image/jpg" in header:
+                    extension = ".jpg"
+                elif "image/png" in header:
                     extension = ".png"
-                    if image_data.startswith("data:image"):
-                        print(f"[DEBUG] Stripping data:image prefix")
-                        header, image_data = image_data.split(",", 1)
-                        # Extract format (e.g., "data:image/jpeg;base64" -> ".jpeg")
-                        if "image/jpeg" in header or "image/jpg" in header:
-                            extension = ".jpg"
-                        elif "image/png" in header:
-                            extension = ".png"
-                        elif "image/gif" in header:
-                            extension = ".gif"
-                        elif "image/webp" in header:
-                            extension = ".webp"
-
-                    file_id = f"{int(time.time())}_{uuid.uuid4().hex[:6]}{extension}"
-                    image_path = CANVAS_DIR / file_id
-                    print(f"[DEBUG] Saving to: {image_path}")
+                elif "image/gif" in header:
+                    extension = ".gif"
+                elif "image/webp" in header:
+                    extension = ".webp"
 
-                    try:
-                        image_bytes = base64.b64decode(image_data)
-                        image_path.write_bytes(image_bytes)
-                        url = f"/canvas/{file_id}"
-                        print(f"[DEBUG] Image saved successfully, URL: {url}")
-                    except Exception as e:
-                        print(f"[ERROR] Failed to save image: {e}")
-                        url = ""
-
-                # Set canvas content and broadcast to all displays
-                if url:
-                    state.canvas_content = {"type": "image", "url": url}
-                    print(f"[CANVAS] Broadcasting image to ALL displays: {state.canvas_content}")
-                    print(f"[CANVAS] Connected displays: {get_connected_displays()}")
-                    await broadcast_to("display", {
-                        "type": "state_update",
-                        "state": state.to_dict()
-                    })
-                    await broadcast_to("control", {
-                        "type": "state_update",
-                        "state": state.to_dict()
-                    })
-                    print(f"[CANVAS] Broadcast complete")
-                else:
-                    print(f"[ERROR] No URL to broadcast")
+            try:
+                url = await blocking.run("upload_decode", store_base64_image, image_data, extension)
+            except Exception as e:
+                server_log(f"[CANVAS] Failed to save image: {e!r}", "error")
+                url = ""
+
+        # Set canvas content and broadcast to all displays
+        if url:
+            update["canvasContent"] = {"type": "image", "url": url}
+            server_log(f"[CANVAS] Showing {url}")
+        else:
+            server_log("[CANVAS] Upload had no image to show", "warning")
+        # Publish even without an image so cached snapshots never lag the layout
+        await publish(zone.state.update(update), zone=zone)
 
-    except websockets.exceptions.ConnectionClosed:
-        pass
-    finally:
-        clients.pop(websocket, None)
-        await broadcast_to("control", {
-            "type": "displays_update",
-            "connectedDisplays": get_connected_displays()
-        })
 
+async def handle_client(websocket):
+    """Handle WebSocket client connection."""
+    client_info = {
+        "type": None,
+        "displayId": None,
+        "queue": asyncio.Queue(SEND_QUEUE_SIZE),
+        "degraded": False,
+        "encoding": "json",
+        "deflate": next((ext for ext in websocket.protocol.extensions if isinstance(ext, SelectiveDeflate)), None),
+        "wire": {"textBytes": 0, "sentBytes": 0, "binaryFrames": 0, "encodeSeconds": 0.0}
+    }
+    clients.add(websocket, client_info)
+    sender = asyncio.create_task(client_sender(websocket, client_info))
 
-class HTTPHandler(BaseHTTPRequestHandler):
-    """HTTP request handler for static files."""
+    try:
+        async for message in websocket:
+            started = time.perf_counter()
+            data = json.loads(message)
+            await handle_message(websocket, client_info, data)
+            metrics.observe_message(data.get("type"), time.perf_counter() - started)
 
-    def log_message(self, *args):
+    except websockets.exceptions.ConnectionClosed:
         pass
-
-    def do_GET(self):
-        public = BASE_DIR / "public"
-
-        if self.path == "/" or self.path == "/control":
-            self._serve_file(public / "control.html", "text/html")
-        elif self.path.startswith("/d"):
-            self._serve_file(public / "display.html", "text/html")
-        elif self.path == "/api/library":
-            self._json_response(get_library())
-        elif self.path.startswith("/scenes/"):
-            # Serve scene files from scenes/default or scenes/custom
-            rel_path = self.path.replace("/scenes/", "")
-            file_path = SCENES_DIR / rel_path
-            if file_path.exists() and file_path.is_file():
-                self._serve_file(file_path, self._get_content_type(file_path))
-            else:
-                self.send_error(404)
-        elif self.path.startswith("/canvas/"):
-            # Serve canvas images
-            file_name = self.path.replace("/canvas/", "")
-            file_path = CANVAS_DIR / file_name
-            if file_path.exists() and file_path.is_file():
-                self._serve_file(file_path, self._get_content_type(file_path))
-            else:
-                self.send_error(404)
-        else:
-            file_path = public / self.path.lstrip("/")
-            if file_path.exists() and file_path.is_file():
-                self._serve_file(file_path, self._get_content_type(file_path))
-            else:
-                self.send_error(404)
-
-    def _serve_file(self, path, content_type):
+    finally:
+        sender.cancel()
+        # Unblock any broadcast still waiting on this client
+        while not client_info["queue"].empty():
+            _, fanout = client_info["queue"].get_nowait()
+            if fanout:
+                fanout.done()
+        clients.remove(websocket)
+        if client_info.get("zone"):
+            client_info["zone"].clients.pop(websocket, None)
+        displays_update.trigger()
+        if relay and client_info["type"] == "display":
+            relay.report.trigger()
+
+
+class HTTPRequest:
+    """Parsed HTTP request head."""
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.path, _, query = target.partition("?")
+        self.query = parse_qs(query)
+        self.version = version
+        self.headers = headers
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+class HTTPResponse:
+    """Response to send back; body is bytes, or file an open file streamed from disk."""
+    def __init__(self, status, body=b"", content_type=None, headers=None, file=None, file_size=0):
+        self.status = status
+        self.body = body
+        self.file = file
+        self.file_size = file_size
+        self.headers = dict(headers or {})
+        if content_type:
+            self.headers["Content-Type"] = content_type
+
+
+def parse_http_head(head):
+    """Parse the request line and headers; returns None if malformed."""
+    try:
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ", 2)
+    except ValueError:
+        return None
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    return HTTPRequest(method, target, version, headers)
+
+
+def get_content_type(path):
+    """Content-Type for a file, by extension."""
+    return {
+        ".html": "text/html",
+        ".css": "text/css",
+        ".js": "application/javascript",
+        ".json": "application/json",
+        ".png": "image/png",
+        ".jpg": "image/jpeg",
+        ".jpeg": "image/jpeg",
+        ".gif": "image/gif",
+        ".webp": "image/webp",
+        ".svg": "image/svg+xml",
+    }.get(path.suffix.lower(), "application/octet-stream")
+
+
+def resolve_under(base, rel_path):
+    """Resolve rel_path inside base, or None if it escapes base or isn't a file."""
+    base = base.resolve()
+    path = (base / unquote(rel_path)).resolve()
+    if base not in path.parents or not path.is_file():
+        return None
+    return path
+
+
+class StaticAsset:
+    """A file body and its precompressed variants, keyed by encoding.
+
+    Files over STATIC_CACHE_MAX_FILE have no variants and are streamed from path.
+    """
+    def __init__(self, path, st):
+        self.path = path
+        self.content_type = get_content_type(path)
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.etag_base = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+        self.streamed = st.st_size > STATIC_CACHE_MAX_FILE
+        if self.streamed:
+            self.variants = {}
+            self.nbytes = 0
+            return
+        self.variants = {"identity": path.read_bytes()}
+        if self.content_type in COMPRESSIBLE_TYPES:
+            body = self.variants["identity"]
+            compressed = {"gzip": gzip.compress(body, 9)}
+            if brotli:
+                compressed["br"] = brotli.compress(body)
+            for encoding, data in compressed.items():
+                if len(data) < len(body):
+                    self.variants[encoding] = data
+        self.nbytes = sum(len(data) for data in self.variants.values())
+
+    def etag(self, encoding):
+        if encoding == "identity":
+            return f'"{self.etag_base}"'
+        return f'"{self.etag_base}-{encoding}"'
+
+
+class StaticCache:
+    """LRU cache of static files, revalidated against the file's mtime on every hit."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # (path, mtime, size) -> load in progress, shared by concurrent misses
+        self.loading = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, path):
+        """Return the cached asset for path, reloading it if the file changed."""
         try:
-            self.send_response(200)
-            self.send_header("Content-Type", content_type)
-            self.end_headers()
-            self.wfile.write(path.read_bytes())
-        except Exception:
-            self.send_error(404)
-
-    def _json_response(self, data):
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+            st = path.stat()
+        except OSError:
+            self._drop(path)
+            return None
+        asset = self.entries.get(path)
+        if asset and asset.mtime_ns == st.st_mtime_ns and asset.size == st.st_size:
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return asset
+        self.misses += 1
+        self._drop(path)
+        if st.st_size > STATIC_CACHE_MAX_FILE:
+            # Too big to hold; only its headers are worked out here
+            return StaticAsset(path, st)
+        key = (path, st.st_mtime_ns, st.st_size)
+        load = self.loading.get(key)
+        if not load:
+            load = self.loading[key] = asyncio.create_task(self._load(path, st))
+            load.add_done_callback(lambda _: self.loading.pop(key, None))
+        return await asyncio.shield(load)
+
+    async def _load(self, path, st):
+        try:
+            asset = await blocking.run("static_load", StaticAsset, path, st)
+        except OSError:
+            return None
+        # Replace whatever another load for this path put there meanwhile
+        self._drop(path)
+        self.entries[path] = asset
+        self.bytes += asset.nbytes
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+        return asset
+
+    def _drop(self, path):
+        asset = self.entries.pop(path, None)
+        if asset:
+            self.bytes -= asset.nbytes
+
+    async def warm(self, directories):
+        """Load every file under the given directories."""
+        for directory in directories:
+            for path in sorted(directory.rglob("*")):
+                if path.is_file():
+                    await self.get(path.resolve())
 
-    def _get_content_type(self, path):
-        suffix = path.suffix.lower()
-        return {
-            ".html": "text/html",
-            ".css": "text/css",
-            ".js": "application/javascript",
-            ".json": "application/json",
-            ".png": "image/png",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".gif": "image/gif",
-            ".webp": "image/webp",
-            ".svg": "image/svg+xml",
-        }.get(suffix, "application/octet-stream")
+    def to_dict(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+
+static_cache = StaticCache(STATIC_CACHE_BYTES)
+
+
+def pick_encoding(accept_encoding, asset):
+    """Best precompressed variant the client accepts (br, then gzip)."""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip())
+    for encoding in ("br", "gzip"):
+        if encoding in asset.variants and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+def json_response(data):
+    return HTTPResponse(200, encode(data).encode(), "application/json", {"Cache-Control": "no-store"})
+
+
+async def file_response(request, path, immutable=False):
+    """Serve a file from the static cache, answering conditional requests with 304."""
+    asset = await static_cache.get(path)
+    if not asset:
+        return HTTPResponse(404, b"Not Found", "text/plain")
+    encoding = pick_encoding(request.headers.get("accept-encoding", ""), asset)
+    etag = asset.etag(encoding)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": asset.last_modified,
+        # Canvas uploads and library bodies never change once written; everything else revalidates
+        "Cache-Control": CACHE_IMMUTABLE if immutable else "no-cache"
+    }
+    if len(asset.variants) > 1:
+        headers["Vary"] = "Accept-Encoding"
+    if request.headers.get("if-none-match") == etag:
+        return HTTPResponse(304, headers=headers)
+    since = request.headers.get("if-modified-since")
+    if since and "if-none-match" not in request.headers:
+        try:
+            if asset.mtime_ns // 1_000_000_000 <= parsedate_to_datetime(since).timestamp():
+                return HTTPResponse(304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    if asset.streamed:
+        try:
+            f = await blocking.run("static_read", open, asset.path, "rb")
+        except OSError:
+            return HTTPResponse(404, b"Not Found", "text/plain")
+        return HTTPResponse(200, content_type=asset.content_type, headers=headers, file=f, file_size=asset.size)
+    return HTTPResponse(200, asset.variants[encoding], asset.content_type, headers)
+
+
+async def stream_file(writer, f, size):
+    """Send size bytes of f, reading each chunk on the blocking pool; returns whether all were there."""
+    remaining = size
+    while remaining:
+        chunk = await blocking.run("static_read", f.read, min(STATIC_CHUNK, remaining))
+        if not chunk:
+            return False
+        writer.write(chunk)
+        remaining -= len(chunk)
+        await writer.drain()
+    return True
+
+
+async def route_http(request):
+    """Map a GET/HEAD request to a response."""
+    public = BASE_DIR / "public"
+    path = request.path
+
+    if path == "/" or path == "/control":
+        return await file_response(request, public / "control.html")
+    elif path.startswith("/d"):
+        return await file_response(request, public / "display.html")
+    elif path == "/api/sync":
+        # Scene load times and the timeout the next switch would use
+        connected = get_connected_displays()
+        return json_response({
+            **scene_load_stats.to_dict(),
+            "nextTimeout": {
+                scene: round(scene_load_stats.timeout_for(connected, scene), 3)
+                for scene in sorted(set(scene_load_stats.by_scene) | {state.scene})
+            }
+        })
+    elif path == "/metrics":
+        return HTTPResponse(200, metrics.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+    elif path == "/api/zones":
+        return json_response(zones_dict())
+    elif path == "/api/playlist":
+        return json_response({**playlist.to_dict(), "items": playlist.cues})
+    elif path == "/api/library":
+        try:
+            return json_response(await library_index.query(
+                request.query.get("search", [""])[0],
+                int(request.query.get("offset", ["0"])[0]),
+                int(request.query.get("limit", [str(LIBRARY_PAGE_SIZE)])[0])
+            ))
+        except ValueError:
+            return HTTPResponse(400, b"Bad Request", "text/plain")
+    elif path.startswith("/api/library/"):
+        await library_index.refresh()
+        item = library_index.by_id.get(unquote(path[len("/api/library/"):]))
+        if not item:
+            return HTTPResponse(404, b"Not Found", "text/plain")
+        return json_response({**public_item(item), "history": item["revisions"]})
+    elif path == "/api/stats":
+        return json_response({
+            "fanout": fanout_stats.to_dict(),
+            "encoding": frame_cache.to_dict(),
+            "coalescing": coalescer.to_dict(),
+            "staticCache": static_cache.to_dict(),
+            "tiles": tile_renderer.to_dict(),
+            "clock": get_clock_status(),
+            "logging": log_pipeline.to_dict(),
+            "clients": {**clients.to_dict(), "admission": admission.to_dict(), "displayNotices": displays_update.runs},
+            "snapshots": state_store.to_dict(),
+            "blocking": blocking.to_dict(),
+            "transport": {
+                "binaryFrames": binary_frames.to_dict(),
+                "clients": [wire_stats(info) for info in clients.all.values() if info["type"]]
+            },
+            "relay": relay.to_dict() if relay else None
+        })
 
+    if path.startswith("/canvas/tiles/"):
+        file_path = await tile_renderer.ensure(path[len("/canvas/tiles/"):])
+        if not file_path:
+            return HTTPResponse(404, b"Not Found", "text/plain")
+        return await file_response(request, file_path, immutable=True)
+    elif path.startswith("/scenes/"):
+        # Serve scene files from scenes/default or scenes/custom
+        file_path = resolve_under(SCENES_DIR, path[len("/scenes/"):])
+    elif path.startswith("/canvas/"):
+        file_path = resolve_under(CANVAS_DIR, path[len("/canvas/"):])
+        if not file_path and relay and await relay.fetch("canvas", CANVAS_DIR, unquote(path[len("/canvas/"):])):
+            file_path = resolve_under(CANVAS_DIR, path[len("/canvas/"):])
+    elif path.startswith("/library/"):
+        # Library bodies by content hash
+        file_path = resolve_under(LIBRARY_BLOBS_DIR, path[len("/library/"):])
+        if not file_path and relay and await relay.fetch("library", LIBRARY_BLOBS_DIR, unquote(path[len("/library/"):])):
+            file_path = resolve_under(LIBRARY_BLOBS_DIR, path[len("/library/"):])
+    else:
+        file_path = resolve_under(public, path.lstrip("/"))
+    if not file_path:
+        return HTTPResponse(404, b"Not Found", "text/plain")
+    return await file_response(request, file_path, immutable=path.startswith(("/canvas/", "/library/")))
+
+
+async def receive_upload(request, reader):
+    """Stream a raw image body into CANVAS_DIR, hashing it as it arrives.
+
+    Only one chunk is held in memory at a time. The file is written under a
+    temporary name and renamed to its content hash once complete; if that
+    content is already stored the new copy is discarded and the old one touched.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    ext = IMAGE_TYPES.get(content_type)
+    if not ext:
+        return HTTPResponse(415, b"Unsupported image type", "text/plain")
+    try:
+        length = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        return HTTPResponse(411, b"Length Required", "text/plain")
+    if length > MAX_UPLOAD_BYTES:
+        return HTTPResponse(413, b"Upload too large", "text/plain")
 
-def run_http_server():
-    """Run HTTP server in background thread."""
-    HTTPServer(("0.0.0.0", PORT_HTTP), HTTPHandler).serve_forever()
+    CANVAS_DIR.mkdir(exist_ok=True)
+    tmp_path = CANVAS_DIR / f".upload_{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    started = time.perf_counter()
+    remaining = length
+    try:
+        with open(tmp_path, "wb") as f:
+            while remaining:
+                chunk = await reader.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("upload truncated")
+                digest.update(chunk)
+                await blocking.run("upload_write", f.write, chunk)
+                remaining -= len(chunk)
+        file_id = f"{digest.hexdigest()}{ext}"
+        # Already stored: keep that copy, with its GC grace period restarted
+        try:
+            os.utime(CANVAS_DIR / file_id)
+            tmp_path.unlink()
+        except FileNotFoundError:
+            tmp_path.replace(CANVAS_DIR / file_id)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    elapsed = time.perf_counter() - started
+    metrics.observe_upload(length, elapsed)
+    server_log(f"[UPLOAD] {file_id} ({length} bytes in {elapsed:.2f}s)")
+    return json_response({"url": f"/canvas/{file_id}", "sha256": digest.hexdigest(), "size": length})
+
+
+async def handle_http(reader, writer):
+    """Serve HTTP/1.1 requests on one keep-alive connection."""
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_KEEPALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    asyncio.TimeoutError, ConnectionError):
+                break
+            request = parse_http_head(head)
+            if not request:
+                response, keep_alive = HTTPResponse(400, b"Bad Request", "text/plain"), False
+            elif request.method == "POST" and request.path == "/upload":
+                response = await receive_upload(request, reader)
+                # A rejected upload leaves its body unread on the connection
+                keep_alive = request.keep_alive and response.status == 200
+            elif request.method not in ("GET", "HEAD"):
+                response, keep_alive = HTTPResponse(405, b"Method Not Allowed", "text/plain"), False
+                response.headers["Allow"] = "GET, HEAD"
+            else:
+                try:
+                    response = await route_http(request)
+                except Exception as e:
+                    server_log(f"[HTTP] {request.path}: {e}", "error")
+                    response = HTTPResponse(500, b"Internal Server Error", "text/plain")
+                keep_alive = request.keep_alive
+
+            headers = response.headers
+            headers["Content-Length"] = str(response.file_size if response.file else len(response.body))
+            headers["Connection"] = "keep-alive" if keep_alive else "close"
+            lines = [f"HTTP/1.1 {response.status} {HTTPStatus(response.status).phrase}"]
+            lines += [f"{key}: {value}" for key, value in headers.items()]
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            head_only = request and request.method == "HEAD"
+            try:
+                if response.file and not head_only:
+                    # A file that shrank since it was stat'ed can't fill Content-Length; end the connection
+                    if not await stream_file(writer, response.file, response.file_size):
+                        keep_alive = False
+                elif not head_only:
+                    writer.write(response.body)
+            finally:
+                if response.file:
+                    response.file.close()
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
 
 
 async def main():
@@ -598,6 +3130,12 @@ async def main():
     CUSTOM_DIR.mkdir(exist_ok=True)
     CANVAS_DIR.mkdir(exist_ok=True)
     (SCENES_DIR / "custom").mkdir(parents=True, exist_ok=True)
+    await library_index.refresh()
+    # A relay gets its state from the primary instead
+    if not relay and state_store.restore():
+        server_log(f"[STATE] Restored snapshot v{state.version} (scene {state.scene})")
+    if not relay:
+        load_zones()
     ip = get_local_ip()
 
     print(f"""
@@ -611,20 +3149,68 @@ async def main():
   LAN Access:     http://{ip}:{PORT_HTTP}/
 
   Library:        {CUSTOM_DIR}
+  Mode:           {f"relay of {relay.url}" if relay else "primary"}
 
 {'='*50}
 """)
 
-    threading.Thread(target=run_http_server, daemon=True).start()
-
-    # Start log broadcaster
-    asyncio.create_task(log_broadcaster())
+    await static_cache.warm([BASE_DIR / "public", SCENES_DIR / "default"])
+    http_server = await asyncio.start_server(handle_http, "0.0.0.0", PORT_HTTP)
+
+    # Background tasks
+    asyncio.create_task(image_gc_loop())
+    asyncio.create_task(clock_status_broadcaster())
+    asyncio.create_task(loop_lag_monitor())
+    asyncio.create_task(metrics_feed())
+    asyncio.create_task(state_store.run())
+
+    if relay:
+        asyncio.create_task(relay.run())
+    # Unattended installations: resume the saved playlist
+    elif playlist.load_file():
+        server_log(f"[PLAYLIST] Resuming {PLAYLIST_FILE.name} ({len(playlist.cues)} cues)")
+        playlist.play()
+
+    # SIGTERM stops the server cleanly (Ctrl+C is handled by asyncio.run)
+    stop = asyncio.get_running_loop().create_future()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    except NotImplementedError:
+        pass
 
-    async with websockets.serve(handle_client, "0.0.0.0", PORT_WS, max_size=50*1024*1024):
-        await asyncio.Future()
+    try:
+        async with http_server, websockets.serve(
+            handle_client, "0.0.0.0", PORT_WS, max_size=50*1024*1024, compression=None,
+            extensions=[SelectiveDeflateFactory(
+                server_max_window_bits=DEFLATE_WINDOW_BITS,
+                client_max_window_bits=DEFLATE_WINDOW_BITS,
+                compress_settings={"memLevel": 5, "level": DEFLATE_LEVEL}
+            )]
+        ):
+            await stop
+    finally:
+        if not relay:
+            await state_store.save()
+        tile_renderer.shutdown()
+        blocking.shutdown()
+        log_pipeline.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Display Sync server")
+    parser.add_argument("--port", type=int, default=PORT_HTTP,
+                        help=f"HTTP port; WebSockets use the next one (default {PORT_HTTP})")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default=LOG_LEVEL,
+                        help=f"lowest level to log (default {LOG_LEVEL})")
+    parser.add_argument("--log-json", action="store_true", help="write log lines to stdout as JSON")
+    parser.add_argument("--relay", metavar="URL",
+                        help="run as an edge relay of the primary at this WebSocket URL, e.g. ws://10.0.0.5:3001")
+    args = parser.parse_args()
+    PORT_HTTP, PORT_WS = args.port, args.port + 1
+    log_pipeline.level = LOG_LEVELS[args.log_level]
+    log_pipeline.json = args.log_json
+    if args.relay:
+        relay = Relay(args.relay)
     try:
         asyncio.run(main())
     except KeyboardInterrupt: